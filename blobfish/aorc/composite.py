@@ -1,16 +1,18 @@
 """ Script to handle creation of CONUS composites from s3 mirrors of AORC precip files utilizing and adding to transfer job metadata """
 
-import boto3
 import pathlib
 import os
 import pathlib
 import datetime
+import collections
+import pandas as pd
 import xarray as xr
 import logging
 import zarr.storage as storage
 from io import BytesIO
 from collections.abc import Generator
 from rdflib import XSD, DCAT, DCTERMS, PROV, Graph, Literal
+from rdflib.plugins.sparql import prepareQuery
 from typing import cast
 from zipfile import ZipFile
 from tempfile import TemporaryDirectory
@@ -19,9 +21,11 @@ from contextlib import closing
 
 from .const import RFC_INFO_LIST
 from ..pyrdf import AORC
+from ..utils.cloud_utils import get_client
+from ..utils.rdf_format import iter_graph_files, rdf_format
 
 
-@dataclass
+@dataclass(slots=True)
 class DatedPaths:
     start_date: datetime.datetime
     end_date: datetime.datetime
@@ -56,16 +60,8 @@ class CompositeMembershipMetadata:
 
 class CloudHandler:
     def __init__(self) -> None:
-        self.client = self.__create_client()
-
-    def __create_client(self):
-        client = boto3.client(
-            service_name="s3",
-            aws_access_key_id=os.environ["AWS_ACCESS_KEY_ID"],
-            aws_secret_access_key=os.environ["AWS_SECRET_ACCESS_KEY"],
-            region_name=os.environ["AWS_DEFAULT_REGION"],
-        )
-        return client
+        # Shares the pooled client used by the other s3 utilities
+        self.client = get_client()
 
     def __partition_bucket_key_names(self, s3_path: str) -> tuple[str, str]:
         if not s3_path.startswith("s3://"):
@@ -95,8 +91,9 @@ def create_graph(ttl_directory: str) -> Graph:
     g.bind("dct", DCTERMS)
     g.bind("prov", PROV)
     g.bind("aorc", AORC)
-    for filepath in pathlib.Path(ttl_directory).glob("*.ttl"):
-        g.parse(filepath)
+    # Partitions may be written as turtle or N-Triples (ie by parse_transfer streaming), the format follows the extension
+    for filepath in iter_graph_files(ttl_directory):
+        g.parse(filepath, format=rdf_format(str(filepath)))
     return g
 
 
@@ -105,6 +102,18 @@ def format_xsd_date(xsd_date_object: Literal) -> datetime.datetime:
     return datetime.datetime.strptime(xsd_string, "%Y-%m-%d")
 
 
+# Start date is passed as a bound literal, so the query text is parsed once rather than once per period
+SOURCE_DATASETS_QUERY = prepareQuery(
+    """
+    SELECT  ?mda
+    WHERE   {
+        ?sd ^dcat:startDate/^dct:temporal/^aorc:hasSourceDataset ?mda .
+    }
+    """,
+    initNs={"dcat": DCAT, "dct": DCTERMS, "aorc": AORC},
+)
+
+
 def query_metadata(g: Graph) -> Generator[DatedPaths, None, None]:
     # Get unique start date and end date pairs which denote distinct periods of temporal coverage for datasets
     time_coverage_query = """
@@ -117,14 +126,9 @@ def query_metadata(g: Graph) -> Generator[DatedPaths, None, None]:
     time_results = g.query(time_coverage_query, initNs={"dcat": DCAT})
     for result in time_results:
         start_date, end_date = cast(list, result)
-        new_query = (
-            """
-        SELECT  ?mda
-        WHERE   {\n"""
-            + f"""\t\t"{start_date}"^^xsd:date ^dcat:startDate/^dct:temporal/^aorc:hasSourceDataset ?mda ."""
-            + """\n\t}"""
+        source_results = g.query(
+            SOURCE_DATASETS_QUERY, initBindings={"sd": Literal(str(start_date), datatype=XSD.date)}
         )
-        source_results = g.query(new_query, initNs={"dcat": DCAT, "xsd": XSD, "dct": DCTERMS, "aorc": AORC})
         formatted_start_date = format_xsd_date(start_date)
         formatted_end_date = format_xsd_date(end_date)
         s3_paths = [str(cast(list, result)[0]) for result in source_results]
@@ -151,19 +155,18 @@ def align_hourly_data(
     script_name: str,
 ) -> Generator[tuple[CompositeMembershipMetadata, set[str], int], None, None]:
     directory_path = pathlib.Path(directory)
-    current_datetime = start_date
-    i = 0
-    while current_datetime <= end_date:
-        search_pattern = f"{current_datetime.strftime('*_%Y%m%d%H.nc4')}"
-        match_set = {str(match) for match in directory_path.glob(search_pattern)}
+    # Extracted files are indexed by hour in one directory scan rather than globbing the directory for every hour
+    hourly_matches: dict[str, set[str]] = collections.defaultdict(set)
+    for match in directory_path.glob("*_*.nc4"):
+        hourly_matches[match.stem.rpartition("_")[2]].add(str(match))
+    members = set(source_paths)
+    hours = pd.date_range(start_date, end_date, freq="H")
+    for i, (current_datetime, hour_key) in enumerate(zip(hours.to_pydatetime(), hours.strftime("%Y%m%d%H"))):
+        match_set = hourly_matches.get(hour_key, set())
         if len(match_set) != len(RFC_INFO_LIST):
             logging.error(f"Expected {len(RFC_INFO_LIST)} to match RFC office number, got {len(match_set)}")
             # raise AttributeError
-        yield CompositeMembershipMetadata(
-            current_datetime, docker_image_url, script_name, set(source_paths)
-        ), match_set, i
-        current_datetime += datetime.timedelta(hours=1)
-        i += 1
+        yield CompositeMembershipMetadata(current_datetime, docker_image_url, script_name, members), match_set, i
 
 
 def create_composite_datset(dataset_paths: set[str]) -> xr.Dataset:
@@ -1,4 +1,6 @@
+import re
 from dataclasses import dataclass
+from rdflib import XSD, Literal, URIRef
 
 # from rdflib import Namespace
 
@@ -8,6 +10,18 @@ FIRST_RECORD = "1979-02-01"
 # FTP server host common prefix
 FTP_HOST = "https://hydrology.nws.noaa.gov/pub/aorc-historic"
 
+# Consolidated metadata object of each composite zarr, compiled once for every listing it filters
+ZMETADATA_PATTERN = re.compile(r".*\.zmetadata$")
+
+# RDF terms shared by every dataset record, constructed once
+NETCDF_FORMAT = URIRef("https://publications.europa.eu/resource/authority/file-type/NETCDF")
+ZIP_COMPRESSION = URIRef("https://www.iana.org/assignments/media-types/application/zip")
+MONTHLY_FREQUENCY = URIRef("http://purl.org/cld/freq/monthly")
+PRECIP_KEYWORD = Literal("precipitation", datatype=XSD.string)
+ACCESS_DESCRIPTION = Literal(
+    "Access is restricted based on users credentials for AWS bucket holding data", datatype=XSD.string
+)
+
 
 # # Dataset Namespaces
 # SOURCE_CATALOG = Namespace("s3://tempest/catalogs/aorc/precip/source/#")
@@ -20,7 +34,7 @@ FTP_HOST = "https://hydrology.nws.noaa.gov/pub/aorc-historic"
 # COMPOSITE_ROOT = Namespace("s3://tempest/composites/aorc/precip/")
 
 
-@dataclass
+@dataclass(slots=True)
 class RFCInfo:
     """
     Data Property: Regional Forecast Center (RFC) names and aliases
@@ -44,3 +58,6 @@ RFC_INFO_LIST = [
     RFCInfo("SE", "SOUTHEAST"),
     RFCInfo("WG", "WEST GULF"),
 ]
+
+# RFC info keyed on alias, built once for lookups from keys and shapefile attributes
+RFC_INFO_BY_ALIAS = {rfc.alias: rfc for rfc in RFC_INFO_LIST}
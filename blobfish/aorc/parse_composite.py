@@ -1,14 +1,39 @@
+import os
 import pathlib
 import datetime
 import logging
 import enum
 import re
+import tempfile
+import functools
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass, field
 from rdflib import DCAT, DCTERMS, OWL, PROV, RDF, XSD, Graph, URIRef, BNode, Literal
 from typing import cast, Generator, Any
 
+from .const import NETCDF_FORMAT, ACCESS_DESCRIPTION, ZMETADATA_PATTERN
 from ..pyrdf import AORC
-from ..utils.cloud_utils import get_s3_content, upload_graph_ttl, get_object_body_string
+from ..utils.cloud_utils import (
+    get_s3_content_parallel,
+    list_keys,
+    upload_graph_fileobj,
+    get_object_body_string,
+    get_client,
+)
+from ..utils.ntriples import NTriplesSink
+from ..utils.prefetch import map_as_completed
+from ..utils.rdf_format import rdf_format
+
+logger = logging.getLogger(__name__)
+
+NS_PREFIXES = {"dcat": DCAT, "dct": DCTERMS, "prov": PROV, "aorc": AORC, "owl": OWL, "xsd": XSD}
+
+
+# Member mirror datasets and docker images are shared by every hourly composite of a month, so their terms are cached
+@functools.lru_cache(maxsize=4096)
+def cached_uri(value: str) -> URIRef:
+    return URIRef(value)
 
 
 class AORCFilter(enum.Enum):
@@ -16,7 +41,7 @@ class AORCFilter(enum.Enum):
     RFC = enum.auto()
 
 
-@dataclass
+@dataclass(slots=True)
 class CompletedCompositeMetadata:
     start_time: str
     end_time: str
@@ -26,29 +51,37 @@ class CompletedCompositeMetadata:
     composite_s3_directory: str
     composite_script: str
     public_uri: str = field(init=False)
+    zarr_name: str = field(init=False)
+    member_datasets: tuple[str, ...] = field(init=False)
 
     def __post_init__(self):
-        bucket, *filename_parts = self.composite_s3_directory.replace("s3://", "").split("/")
-        filename = "/".join(filename_parts)
+        bucket, _, filename = self.composite_s3_directory.removeprefix("s3://").partition("/")
         self.public_uri = f"https://{bucket}.s3.amazonaws.com/{filename}"
         self.composite_script = self.composite_script.replace("/", "_")
+        self.zarr_name = filename.rpartition("/")[2].replace(".zarr", "")
+        self.member_datasets = tuple(self.members.split(","))
 
-    def get_member_datasets(self) -> list[str]:
-        return self.members.split(",")
+    def get_member_datasets(self) -> tuple[str, ...]:
+        return self.member_datasets
 
 
 class NodeNamer:
     def __init__(self):
         self.name_set = set()
 
+    def register(self, name: str | tuple[str, ...]) -> bool:
+        """Records a node name, returning False if its describing triples were already emitted for an earlier composite"""
+        if name in self.name_set:
+            return False
+        self.name_set.add(name)
+        return True
+
     def name_ds_period(self, meta: CompletedCompositeMetadata) -> str:
         name = f"{meta.start_time}_{meta.end_time}"
         return name
 
     def name_composite_job(self, meta: CompletedCompositeMetadata) -> str:
-        zarr_fn_index = meta.composite_s3_directory.rfind("/") + 1
-        zarr_fn = meta.composite_s3_directory[zarr_fn_index:]
-        name = f"{meta.composite_script}_{zarr_fn.replace('.zarr', '')}"
+        name = f"{meta.composite_script}_{meta.zarr_name}"
         return name
 
 
@@ -66,8 +99,8 @@ def complete_metadata(composite_object: dict, bucket: str) -> CompletedComposite
         if meta:
             return meta
     except TypeError:
-        logging.error(
-            f"Incomplete composite metadata received from s3 object {composite_object.get('Key')}, could not complete object"
+        logger.error(
+            "Incomplete composite metadata received from s3 object %s, could not complete object", full_key
         )
         return None
 
@@ -75,96 +108,175 @@ def complete_metadata(composite_object: dict, bucket: str) -> CompletedComposite
 def get_meta(
     bucket: str, prefix: str, metadata_pattern: re.Pattern, with_key: bool = True, client: Any | None = None
 ) -> Generator[CompletedCompositeMetadata, None, None]:
-    for obj in get_s3_content(bucket, prefix, with_key, client):
+    match = metadata_pattern.match
+    # Keys are matched against the listing so only metadata objects (not every zarr chunk) get a head request
+    # Listing is partitioned on sub-prefixes (ie years) and run in parallel
+    for obj in get_s3_content_parallel(
+        bucket, prefix, with_key, client, listing_filter=lambda content: match(content.get("Key")) is not None
+    ):
         key = cast(str, obj.get("Key"))
-        if re.match(metadata_pattern, key):
-            meta = complete_metadata(obj, bucket)
-            if meta:
-                yield meta
-            else:
-                logging.info(f"Skipping {key} due to returning None from complete_metadata()")
+        meta = complete_metadata(obj, bucket)
+        if meta:
+            yield meta
+        else:
+            logger.info("Skipping %s due to returning None from complete_metadata()", key)
 
 
 def format_zarr_s3_path(bucket: str, key: str) -> str:
-    if ".zarr" not in key:
-        logging.error(f"Trying to format key for resource which is not a .zarr file: {key}")
-        raise ValueError
-    zarr_path = key[: key.find(".zarr") + len(".zarr")]
-    return f"s3://{bucket}/{zarr_path}"
+    zarr_path, zarr_ext, _ = key.partition(".zarr")
+    if not zarr_ext:
+        raise ValueError(f"Trying to format key for resource which is not a .zarr file: {key}")
+    return f"s3://{bucket}/{zarr_path}{zarr_ext}"
 
 
-def create_graph_local(ttl_directory: str, pattern: str) -> Graph:
-    g = Graph()
-    g.bind("dcat", DCAT)
-    g.bind("dct", DCTERMS)
-    g.bind("prov", PROV)
-    g.bind("aorc", AORC)
-    for filepath in pathlib.Path(ttl_directory).glob(pattern):
-        g.parse(filepath)
+def new_graph(store: str = "default") -> Graph:
+    """Creates a graph bound to only the prefixes used in composite graphs, skipping the default set bound by rdflib"""
+    g = Graph(store=store, bind_namespaces="none")
+    for prefix, ns in NS_PREFIXES.items():
+        g.bind(prefix, ns)
     return g
 
 
-def create_graph_s3(bucket: str, prefix: str, client: Any | None = None):
+def to_ntriples(source: bytes | pathlib.Path, source_format: str) -> bytes:
+    """Parses serialized RDF and returns the N-Triples serialization, which is much cheaper to parse than turtle"""
     g = Graph()
-    g.bind("dcat", DCAT)
-    g.bind("dct", DCTERMS)
-    g.bind("prov", PROV)
-    g.bind("aorc", AORC)
-    for obj in get_s3_content(bucket, prefix, True, client):
-        obj = get_object_body_string(bucket, cast(str, obj.get("Key")), client)
-        g.parse(data=obj.read())
+    if isinstance(source, bytes):
+        g.parse(data=source, format=source_format)
+    else:
+        g.parse(source, format=source_format)
+    return g.serialize(format="nt", encoding="utf-8")
+
+
+def parse_to_ntriples(filepath: pathlib.Path) -> bytes:
+    """Worker function which parses a single RDF file and returns its N-Triples serialization"""
+    return to_ntriples(filepath, rdf_format(str(filepath)))
+
+
+def iter_ntriples_local(ttl_directory: str, pattern: str, processes: int | None = None) -> Generator[bytes, None, None]:
+    # Files are parsed in worker processes and yielded as each finishes, only a window of results is held in memory
+    workers = processes or os.cpu_count() or 1
+    filepaths = pathlib.Path(ttl_directory).glob(pattern)
+    yield from map_as_completed(parse_to_ntriples, filepaths, workers, 2 * workers, ProcessPoolExecutor)
+
+
+def iter_graph_objects_s3(
+    bucket: str, prefix: str, client: Any | None = None, workers: int = 64
+) -> Generator[tuple[str, bytes], None, None]:
+    if not client:
+        client = get_client()
+
+    def read_object(key: str) -> tuple[str, bytes]:
+        return key, get_object_body_string(bucket, key, client).read()
+
+    # Objects are downloaded concurrently and yielded as each download finishes, so a slow response does not hold up
+    # parsing of the objects behind it; only a window of downloads is held in memory at once
+    yield from map_as_completed(read_object, list_keys(bucket, prefix, client), workers, 2 * workers)
+
+
+def create_graph_local(
+    ttl_directory: str, pattern: str, processes: int | None = None, store: str = "default"
+) -> Graph:
+    g = new_graph(store)
+    for ntriples in iter_ntriples_local(ttl_directory, pattern, processes):
+        g.parse(data=ntriples, format="nt")
     return g
 
 
-def create_graph_triples(meta: CompletedCompositeMetadata, merged_graph: Graph, node_namer: NodeNamer):
-    # Create composite dataset
-    composite_dataset_uri = URIRef(meta.composite_s3_directory)
-    merged_graph.add((composite_dataset_uri, RDF.type, AORC.CompositeDataset))
-
-    # Add composite dataset properties
-    composite_dataset_period_of_time_node = BNode(node_namer.name_ds_period(meta))
-    merged_graph.add((composite_dataset_period_of_time_node, RDF.type, DCTERMS.PeriodOfTime))
-    merged_graph.add((composite_dataset_uri, DCTERMS.temporal, composite_dataset_period_of_time_node))
-    start_time = Literal(meta.start_time, datatype=XSD.dateTime)
-    end_time = Literal(meta.end_time, datatype=XSD.dateTime)
-    merged_graph.add((composite_dataset_period_of_time_node, DCAT.startDate, start_time))
-    merged_graph.add((composite_dataset_period_of_time_node, DCAT.endDate, end_time))
-
-    # Create distribution
-    composite_distribution_uri = URIRef(meta.public_uri)
-    merged_graph.add((composite_distribution_uri, RDF.type, AORC.CompositeDistribution))
-    netcdf_format = URIRef("https://publications.europa.eu/resource/authority/file-type/NETCDF")
-    merged_graph.add((composite_distribution_uri, DCAT.packageFormat, netcdf_format))
-    last_modified = Literal(meta.composite_last_modified, datatype=XSD.dateTime)
-    merged_graph.add((composite_dataset_uri, DCTERMS.created, last_modified))
-    access_description = Literal(
-        "Access is restricted based on users credentials for AWS bucket holding data", datatype=XSD.string
-    )
-    merged_graph.add((composite_distribution_uri, OWL.Annotation, access_description))
+def create_graph_s3(
+    bucket: str, prefix: str, client: Any | None = None, store: str = "default", workers: int = 64
+) -> Graph:
+    g = new_graph(store)
+    for key, body in iter_graph_objects_s3(bucket, prefix, client, workers):
+        g.parse(data=body, format=rdf_format(key))
+    return g
 
-    # Create docker image
-    docker_image_uri = URIRef(meta.docker_image_url)
-    merged_graph.add((docker_image_uri, RDF.type, AORC.DockerImage))
 
-    # Create composite job
-    composite_job_node = BNode(node_namer.name_composite_job(meta))
-    merged_graph.add((composite_job_node, RDF.type, AORC.CompositeJob))
+def stream_graph_local(ttl_directory: str, pattern: str, sink: NTriplesSink, processes: int | None = None) -> None:
+    for ntriples in iter_ntriples_local(ttl_directory, pattern, processes):
+        sink.write_ntriples(ntriples)
+
 
-    # Create script
+def stream_graph_s3(
+    bucket: str, prefix: str, sink: NTriplesSink, client: Any | None = None, workers: int = 64
+) -> None:
+    for key, body in iter_graph_objects_s3(bucket, prefix, client, workers):
+        object_format = rdf_format(key)
+        if object_format != "nt":
+            body = to_ntriples(body, object_format)
+        elif not body.endswith(b"\n"):
+            body += b"\n"
+        sink.write_ntriples(body)
+
+
+def create_graph_triples(
+    meta: CompletedCompositeMetadata, merged_graph: Graph | NTriplesSink, node_namer: NodeNamer
+) -> None:
+    composite_dataset_uri = URIRef(meta.composite_s3_directory)
+    period_name = node_namer.name_ds_period(meta)
+    composite_dataset_period_of_time_node = BNode(period_name)
+    composite_distribution_uri = URIRef(meta.public_uri)
+    docker_image_uri = cached_uri(meta.docker_image_url)
+    composite_job_node = BNode(node_namer.name_composite_job(meta))
     composite_script_node = BNode(meta.composite_script)
-    merged_graph.add((composite_script_node, RDF.type, AORC.CompositeScript))
-    merged_graph.add((composite_script_node, DCTERMS.identifier, Literal(meta.composite_script)))
 
-    # Associate docker image, script, job, and dataset generated
-    merged_graph.add((composite_dataset_uri, AORC.wasCompositedBy, composite_job_node))
-    merged_graph.add((composite_job_node, PROV.wasStartedBy, composite_script_node))
-    merged_graph.add((composite_script_node, AORC.hasDockerImage, docker_image_uri))
+    # Triples are collected as quads and added in one batch
+    triples = [
+        # Create composite dataset
+        (composite_dataset_uri, RDF.type, AORC.CompositeDataset, merged_graph),
+        (composite_dataset_uri, DCTERMS.temporal, composite_dataset_period_of_time_node, merged_graph),
+        # Create distribution
+        (composite_distribution_uri, RDF.type, AORC.CompositeDistribution, merged_graph),
+        (composite_distribution_uri, DCAT.packageFormat, NETCDF_FORMAT, merged_graph),
+        (
+            composite_dataset_uri,
+            DCTERMS.created,
+            Literal(meta.composite_last_modified, datatype=XSD.dateTime),
+            merged_graph,
+        ),
+        (composite_distribution_uri, OWL.Annotation, ACCESS_DESCRIPTION, merged_graph),
+        # Create composite job
+        (composite_job_node, RDF.type, AORC.CompositeJob, merged_graph),
+        # Associate job and dataset generated
+        (composite_dataset_uri, AORC.wasCompositedBy, composite_job_node, merged_graph),
+        (composite_job_node, PROV.wasStartedBy, composite_script_node, merged_graph),
+    ]
+
+    # Periods, scripts, and docker images are shared by many composites, so they are only described once
+    if node_namer.register(period_name):
+        triples.extend(
+            (
+                (composite_dataset_period_of_time_node, RDF.type, DCTERMS.PeriodOfTime, merged_graph),
+                (
+                    composite_dataset_period_of_time_node,
+                    DCAT.startDate,
+                    Literal(meta.start_time, datatype=XSD.dateTime),
+                    merged_graph,
+                ),
+                (
+                    composite_dataset_period_of_time_node,
+                    DCAT.endDate,
+                    Literal(meta.end_time, datatype=XSD.dateTime),
+                    merged_graph,
+                ),
+            )
+        )
+    if node_namer.register((meta.composite_script, meta.docker_image_url)):
+        triples.extend(
+            (
+                (docker_image_uri, RDF.type, AORC.DockerImage, merged_graph),
+                (composite_script_node, RDF.type, AORC.CompositeScript, merged_graph),
+                (composite_script_node, DCTERMS.identifier, Literal(meta.composite_script), merged_graph),
+                (composite_script_node, AORC.hasDockerImage, docker_image_uri, merged_graph),
+            )
+        )
 
     # Associate members of composite with composite dataset and composite job
     for member_dataset in meta.get_member_datasets():
-        member_dataset_uri = URIRef(member_dataset)
-        merged_graph.add((composite_dataset_uri, AORC.isCompositeOf, member_dataset_uri))
-        merged_graph.add((composite_job_node, PROV.used, member_dataset_uri))
+        member_dataset_uri = cached_uri(member_dataset)
+        triples.append((composite_dataset_uri, AORC.isCompositeOf, member_dataset_uri, merged_graph))
+        triples.append((composite_job_node, PROV.used, member_dataset_uri, merged_graph))
+
+    merged_graph.addN(triples)
 
 
 def main(
@@ -178,36 +290,100 @@ def main(
     to_s3: bool = False,
     target_bucket: str | None = None,
     client: Any | None = None,
+    store: str = "default",
+    stream: bool = False,
+    compress: bool = False,
 ) -> None:
     # TODO: Add size limiter which serializes after ttl string goes over set limit
+    # compress stores the uploaded graph gzipped with Content-Encoding gzip, local output is unaffected
+    # store accepts any registered rdflib store plugin name, ie "Oxigraph" when oxrdflib is installed
     node_namer = NodeNamer()
+    # Share one client across graph loading, metadata retrieval, and upload
+    if not client:
+        client = get_client()
+    if stream:
+        stream_composite_graph(
+            ttl_directory,
+            ttl_pattern,
+            composites_bucket,
+            composites_prefix,
+            composites_metadata_pattern,
+            output_path,
+            node_namer,
+            client,
+            from_s3,
+            to_s3,
+            target_bucket,
+            compress,
+        )
+        return
     if from_s3:
-        g = create_graph_s3(ttl_directory, ttl_pattern, client)
+        g = create_graph_s3(ttl_directory, ttl_pattern, client, store)
     else:
-        g = create_graph_local(ttl_directory, ttl_pattern)
-    for meta in get_meta(composites_bucket, composites_prefix, composites_metadata_pattern):
+        g = create_graph_local(ttl_directory, ttl_pattern, store=store)
+    for meta in get_meta(composites_bucket, composites_prefix, composites_metadata_pattern, True, client):
         create_graph_triples(meta, g, node_namer)
+    # Format follows output path extension, ie .jelly for compact binary output or .ttl for human readable output
+    output_format = rdf_format(output_path)
     if to_s3 and target_bucket:
-        ttl_body = g.serialize(format="ttl")
-        upload_graph_ttl(target_bucket, output_path, ttl_body, client)
+        # Serialization spills to disk past 64 MB rather than being held as one string
+        with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as graph_body:
+            g.serialize(graph_body, format=output_format, encoding="utf-8")
+            upload_graph_fileobj(target_bucket, output_path, graph_body, client, compress)
     else:
-        g.serialize("logs/composite.ttl", format="ttl")
+        g.serialize(output_path, format=output_format, encoding="utf-8")
+
+
+def stream_composite_graph(
+    ttl_directory: str,
+    ttl_pattern: str,
+    composites_bucket: str,
+    composites_prefix: str,
+    composites_metadata_pattern: re.Pattern,
+    output_path: str,
+    node_namer: NodeNamer,
+    client: Any,
+    from_s3: bool = False,
+    to_s3: bool = False,
+    target_bucket: str | None = None,
+    compress: bool = False,
+) -> None:
+    """Same as main, but input graphs and composite triples are written straight out as N-Triples
+    without building an rdflib graph. Output is always N-Triples with escaped blank node labels, which is also
+    valid turtle, so output_path should end in .nt or .ttl
+    """
+    if rdf_format(output_path) not in ("nt", "turtle"):
+        raise ValueError(f"Streamed composite graph is written as N-Triples, cannot write to {output_path}")
+    with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as graph_body:
+        sink = NTriplesSink(graph_body)
+        if from_s3:
+            stream_graph_s3(ttl_directory, ttl_pattern, sink, client)
+        else:
+            stream_graph_local(ttl_directory, ttl_pattern, sink)
+        for meta in get_meta(composites_bucket, composites_prefix, composites_metadata_pattern, True, client):
+            create_graph_triples(meta, sink, node_namer)
+        if to_s3 and target_bucket:
+            upload_graph_fileobj(target_bucket, output_path, graph_body, client, compress)
+        else:
+            graph_body.seek(0)
+            with open(output_path, "wb") as f:
+                shutil.copyfileobj(graph_body, f)
+    logger.info("Composite graph streamed to %s", output_path)
 
 
 if __name__ == "__main__":
-    from ..utils.cloud_utils import view_downloads, clear_downloads, get_client
+    from ..utils.cloud_utils import view_downloads, clear_downloads
     from dotenv import load_dotenv
 
     load_dotenv()
     client = get_client()
     bucket = "tempest"
-    metadata_pattern = re.compile(r".*\.zmetadata$")
     main(
         bucket,
         "graphs/aorc/precip/1979",
         bucket,
         "transforms",
-        metadata_pattern,
+        ZMETADATA_PATTERN,
         "graphs/transforms.ttl",
         True,
         True,
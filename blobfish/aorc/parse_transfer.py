@@ -1,19 +1,101 @@
 """ Script to parse metadata from uploaded mirror files and create a rdf graph network using the ontology defined in ./pyrdf/_AORC.py """
 import rdflib
+import calendar
+import collections
 import datetime
+import os
 import requests
 import logging
 import enum
-from dateutil import relativedelta
+import functools
+import glob
+import json
+import pathlib
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from botocore.exceptions import ClientError
 from dataclasses import dataclass, field
-from typing import cast, Any
+from typing import cast, Any, Generator, Iterable
 from rdflib import RDF, OWL, XSD, DCAT, DCTERMS, PROV, Literal, URIRef, BNode
 
+from .const import ACCESS_DESCRIPTION, MONTHLY_FREQUENCY, NETCDF_FORMAT, PRECIP_KEYWORD, ZIP_COMPRESSION
 from .transfer import TransferMetadata
 
 from ..pyrdf import AORC
 from ..utils.logger import set_up_logger
-from ..utils.cloud_utils import get_s3_content, get_client, upload_graph_ttl
+from ..utils.cloud_utils import (
+    get_s3_content_parallel,
+    get_client,
+    list_keys,
+    put_object_body,
+    upload_graph_fileobj,
+    get_object_body_string,
+)
+from ..utils.ntriples import NTriplesSink
+from ..utils.prefetch import prefetch, map_ahead
+from ..utils.rdf_format import rdf_format
+
+
+NS_PREFIXES = {"dcat": DCAT, "prov": PROV, "dct": DCTERMS, "aorc": AORC}
+
+
+# Cached term factories so values repeated across records (ie reference dates, RFC names, partition uris) are only
+# constructed once; per record values such as sizes and modification times are built directly
+@functools.lru_cache(maxsize=4096)
+def str_literal(value: str) -> Literal:
+    return Literal(value, datatype=XSD.string)
+
+
+@functools.lru_cache(maxsize=4096)
+def plain_literal(value: str) -> Literal:
+    return Literal(value)
+
+
+@functools.lru_cache(maxsize=4096)
+def date_literal(value: str) -> Literal:
+    return Literal(value, datatype=XSD.date)
+
+
+@functools.lru_cache(maxsize=4096)
+def cached_uri(value: str) -> URIRef:
+    return URIRef(value)
+
+
+def get_session() -> requests.Session:
+    # Sessions keep connections to weather.gov alive across validation requests, one per process like the s3 client
+    return _get_process_session(os.getpid())
+
+
+@functools.lru_cache(maxsize=None)
+def _get_process_session(pid: int) -> requests.Session:
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
+    return session
+
+
+# One lock per RFC alias, so records completed concurrently for the same office wait on a single validation request
+_RFC_PAGE_LOCKS: dict[str, threading.Lock] = dict()
+
+
+def validate_rfc_office_page(rfc_alias: str) -> str:
+    with _RFC_PAGE_LOCKS.setdefault(rfc_alias, threading.Lock()):
+        return _validate_rfc_office_page(rfc_alias)
+
+
+@functools.lru_cache(maxsize=32)
+def _validate_rfc_office_page(rfc_alias: str) -> str:
+    # Only a handful of RFC offices exist, so each page is checked once per process; failures are not cached
+    url = f"https://www.weather.gov/{rfc_alias}rfc"
+    resp = get_session().head(url, allow_redirects=True, timeout=5)
+    if resp.ok:
+        return url
+    else:
+        logging.error(f"rfc homepage url {url} not valid")
+        raise requests.exceptions.RequestException
 
 
 class AORCFilter(enum.Enum):
@@ -22,60 +104,203 @@ class AORCFilter(enum.Enum):
 
 
 class GraphCreator:
-    def __init__(self, bindings: dict) -> None:
+    def __init__(self, bindings: dict, stream: bool = False) -> None:
         self.bindings = bindings
+        # When streaming, triples are written straight out as N-Triples instead of being held in an rdflib graph
+        self.stream = stream
         self.filter_graphs = dict()
         self.default_graph = None
-
-    def __create_graph(self) -> rdflib.Graph:
+        # Shared between merges so named blank nodes (ie transfer script) resolve to the same node across batches
+        self.bnode_context = dict()
+        # Nodes shared by many records (ie RFC offices, transfer scripts) which are already described in each graph
+        self.emitted_nodes = collections.defaultdict(set)
+
+    def __create_graph(self) -> rdflib.Graph | NTriplesSink:
+        if self.stream:
+            logging.info("NTriplesSink object created by graph creator")
+            return NTriplesSink(tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024))
         logging.info("rdflib.Graph object created by graph creator")
         g = rdflib.Graph()
         for prefix, ns in self.bindings.items():
             g.bind(prefix, ns)
         return g
 
-    def get_graph(self, filter_key: str | None = None) -> rdflib.Graph:
+    def get_graph(self, filter_key: str | None = None) -> rdflib.Graph | NTriplesSink:
         if filter_key:
             filter_graph = self.filter_graphs.get(filter_key)
-            if filter_graph:
+            if filter_graph is not None:
                 return filter_graph
             logging.info(f"No graph found for filter key {filter_key}")
             filter_graph = self.__create_graph()
             self.filter_graphs[filter_key] = filter_graph
             return filter_graph
-        if self.default_graph:
+        if self.default_graph is not None:
             return self.default_graph
         self.default_graph = self.__create_graph()
         return self.default_graph
 
+    def mark_emitted(self, filter_key: str | None, node: Any) -> bool:
+        """Records that a shared node has been described in the graph for filter_key
+
+        Returns:
+            bool: True if this is the first time the node is described in that graph
+        """
+        emitted = self.emitted_nodes[filter_key]
+        if node in emitted:
+            return False
+        emitted.add(node)
+        return True
+
+    def iter_graphs(self) -> Generator[tuple[str | None, rdflib.Graph | NTriplesSink], None, None]:
+        for filter_key, filter_graph in self.filter_graphs.items():
+            yield filter_key, filter_graph
+        if self.default_graph is not None:
+            yield None, self.default_graph
+
+    def load_existing(
+        self, filepath_pattern: str, from_s3: bool = False, client: Any | None = None, bucket: str | None = None
+    ) -> list[rdflib.Graph]:
+        """Loads graphs serialized by a previous run into the matching partitions so new triples are added onto them
+
+        Args:
+            filepath_pattern (str): Pattern used when the graphs were serialized
+            from_s3 (bool, optional): If True, read serialized graphs from s3 bucket. Defaults to False.
+            client (Any | None, optional): s3 client. Defaults to None.
+            bucket (str | None, optional): Bucket holding serialized graphs. Defaults to None.
+
+        Returns:
+            list[rdflib.Graph]: Graphs which were loaded
+        """
+        prefix, _, suffix = filepath_pattern.partition("{0}")
+        existing_graphs = []
+        if from_s3 and bucket:
+            serialized = (
+                (key, get_object_body_string(bucket, key, client).read())
+                for key in list_keys(bucket, prefix, client)
+                if key.endswith(suffix)
+            )
+        else:
+            serialized = ((fn, pathlib.Path(fn).read_bytes()) for fn in glob.glob(filepath_pattern.format("*")))
+        for fn, data in serialized:
+            filter_key = fn[len(prefix) : len(fn) - len(suffix)] or None
+            parsed_graph = rdflib.Graph()
+            parsed_graph.parse(data=data, format=rdf_format(fn))
+            existing_graph = self.__restore_named_nodes(parsed_graph)
+            graph = self.get_graph(filter_key)
+            graph.addN((s, p, o, graph) for s, p, o in existing_graph)
+            self.__seed_emitted(filter_key, existing_graph)
+            existing_graphs.append(existing_graph)
+            logging.info(f"Loaded {len(existing_graph)} triples from existing graph {fn}")
+        return existing_graphs
+
+    def __restore_named_nodes(self, parsed_graph: rdflib.Graph) -> rdflib.Graph:
+        """Replaces the parse scoped blank nodes of shared periods and transfer scripts with the named nodes
+        create_graph_triples uses for them, so new records link to the loaded nodes instead of describing copies"""
+        named_nodes = dict()
+        for script_node in parsed_graph.subjects(RDF.type, AORC.TransferScript):
+            identifier = parsed_graph.value(script_node, DCTERMS.identifier)
+            if isinstance(script_node, BNode) and identifier is not None:
+                named_nodes[script_node] = BNode(str(identifier))
+        for period_node in parsed_graph.subjects(RDF.type, DCTERMS.PeriodOfTime):
+            start = parsed_graph.value(period_node, DCAT.startDate)
+            end = parsed_graph.value(period_node, DCAT.endDate)
+            if isinstance(period_node, BNode) and start is not None and end is not None:
+                named_nodes[period_node] = BNode(f"{start}_{end}")
+        # Batches merged from worker processes resolve the same labels to the restored nodes
+        for named_node in named_nodes.values():
+            self.bnode_context[str(named_node)] = named_node
+        existing_graph = rdflib.Graph()
+        existing_graph.addN(
+            (named_nodes.get(s, s), p, named_nodes.get(o, o), existing_graph) for s, p, o in parsed_graph
+        )
+        return existing_graph
+
+    def __seed_emitted(self, filter_key: str | None, existing_graph: rdflib.Graph) -> None:
+        """Marks the shared nodes described in a loaded graph as emitted so they are not described again"""
+        for period_node in existing_graph.subjects(RDF.type, DCTERMS.PeriodOfTime):
+            self.mark_emitted(filter_key, period_node)
+        for script_node in existing_graph.subjects(RDF.type, AORC.TransferScript):
+            self.mark_emitted(filter_key, script_node)
+        for docker_image_uri, script_node in existing_graph.subject_objects(AORC.hasTransferScript):
+            self.mark_emitted(filter_key, (docker_image_uri, script_node))
+        for rfc_office_uri in existing_graph.subjects(RDF.type, AORC.RFC):
+            rfc_name = existing_graph.value(rfc_office_uri, AORC.hasRFCName)
+            rfc_alias = existing_graph.value(rfc_office_uri, AORC.hasRFCAlias)
+            self.mark_emitted(filter_key, (rfc_office_uri, str(rfc_name), str(rfc_alias)))
+        for precip_partition_uri, rfc_office_uri in existing_graph.subject_objects(AORC.hasRFC):
+            self.mark_emitted(filter_key, (precip_partition_uri, rfc_office_uri))
+
+    def merge_ntriples(self, filter_key: str | None, ntriples: bytes) -> None:
+        graph = self.get_graph(filter_key)
+        if isinstance(graph, NTriplesSink):
+            # Batches for streamed graphs are written by NTriplesSink, so their escaped labels keep named nodes merged
+            graph.write_ntriples(ntriples)
+        else:
+            graph.parse(data=ntriples, format="nt", bnode_context=self.bnode_context)
+
     def serialize_graphs(
-        self, filepath_pattern: str, to_s3: bool = False, client: Any | None = None, bucket: str | None = None
+        self,
+        filepath_pattern: str,
+        to_s3: bool = False,
+        client: Any | None = None,
+        bucket: str | None = None,
+        workers: int = 8,
     ) -> None:
-        if len(self.filter_graphs.items()) > 0:
-            for filter_key, filter_graph in self.filter_graphs.items():
-                fn = filepath_pattern.format(filter_key)
-                if to_s3 and bucket:
-                    ttl_body = filter_graph.serialize(format="ttl")
-                    upload_graph_ttl(bucket, fn, ttl_body, client)
-                else:
-                    filter_graph.serialize(fn, format="ttl")
-                    logging.info(f"Graph serialized to {fn}")
-        elif self.default_graph:
-            fn = filepath_pattern.format("")
-            self.default_graph.serialize(fn, format="ttl")
-            logging.info(f"Graph serialized to {fn}")
-        else:
+        graphs = list(self.iter_graphs())
+        if len(graphs) == 0:
             logging.error(f"No graph object was created, serialization failed")
             raise ValueError
+        # Partitions are written concurrently so uploads of one partition overlap serialization of the others
+        with ThreadPoolExecutor(max_workers=min(workers, len(graphs))) as executor:
+            futures = [
+                executor.submit(
+                    self.__serialize_graph, graph, filepath_pattern.format(filter_key or ""), to_s3, client, bucket
+                )
+                for filter_key, graph in graphs
+            ]
+            for future in futures:
+                future.result()
+
+    @staticmethod
+    def __serialize_graph(
+        graph: rdflib.Graph | NTriplesSink, fn: str, to_s3: bool, client: Any | None, bucket: str | None
+    ) -> None:
+        if isinstance(graph, NTriplesSink):
+            # Streamed output is always N-Triples, which is also valid turtle
+            if to_s3 and bucket:
+                # Sent as a multipart upload once the partition passes the part size
+                upload_graph_fileobj(bucket, fn, graph.fileobj, client)
+            else:
+                graph.fileobj.seek(0)
+                with open(fn, "wb") as f:
+                    shutil.copyfileobj(graph.fileobj, f)
+            graph.close()
+            logging.info(f"Graph streamed to {fn}")
+            return
+        # N-Triples (.nt) skips the prefix folding and predicate grouping done by the turtle serializer,
+        # and .jelly writes the compact binary format when the pyjelly plugin is installed
+        output_format = rdf_format(fn)
+        if to_s3 and bucket:
+            # Serialization spills to disk past 64 MB rather than being held as one string
+            with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as body:
+                graph.serialize(body, format=output_format, encoding="utf-8")
+                upload_graph_fileobj(bucket, fn, body, client)
+        else:
+            graph.serialize(fn, format=output_format, encoding="utf-8")
+        logging.info(f"Graph serialized to {fn}")
 
 
-@dataclass
+@dataclass(slots=True)
 class CompletedTransferMetadata(TransferMetadata):
     mirror_last_modified: str
     bucket: str
     mirror_public_uri: str = field(init=False)
     ref_end_date: str = field(init=False)
     rfc_office_uri: str = field(init=False)
+    # Source file name without extension, shared by the source dataset and transfer job names
+    source_basename: str = field(init=False)
+    precip_partition_url: str = field(init=False)
+    source_distribution_url: str = field(init=False)
 
     def __post_init__(self):
         # Create public s3 address
@@ -84,50 +309,84 @@ class CompletedTransferMetadata(TransferMetadata):
         self.mirror_public_uri = public_uri
 
         # Calculate and format end duration for dataset
-        ref_end_datetime = (
-            datetime.datetime.strptime(self.ref_date, "%Y-%m-%d")
-            + relativedelta.relativedelta(months=1, day=1)
-            - datetime.timedelta(days=1)
-        )
-        self.ref_end_date = ref_end_datetime.strftime("%Y-%m-%d")
+        ref_date = datetime.date.fromisoformat(self.ref_date)
+        month_days = calendar.monthrange(ref_date.year, ref_date.month)[1]
+        self.ref_end_date = ref_date.replace(day=month_days).isoformat()
 
-        # Format source last modified property
+        # Format source last modified property, HTTP dates are always GMT so the naive datetime is kept for existing graphs
         if self.source_last_modified:
-            self.source_last_modified = datetime.datetime.strptime(
-                self.source_last_modified, "%a, %d %b %Y %H:%M:%S %Z"
-            ).isoformat()
+            self.source_last_modified = (
+                parsedate_to_datetime(self.source_last_modified).replace(tzinfo=None).isoformat()
+            )
 
         # Format transfer script to make it parseable
         self.mirror_script = self.mirror_script.replace("/", "_")
 
+        # Derive names and urls used by several triples once
+        self.source_basename = NodeNamer.source_name(self.source_uri)
+        self.precip_partition_url = f"{self.aorc_historic_uri}{self.rfc_catalog_uri}{self.precip_partition_uri}"
+        self.source_distribution_url = f"{self.precip_partition_url}{self.source_uri}"
+
         # Get validated page for RFC office
-        self.rfc_office_uri = self.__validate_rfc_office_page()
+        self.rfc_office_uri = validate_rfc_office_page(self.rfc_alias.lower())
         logging.info(f"Metadata completed for {self.mirror_uri}")
 
-    def __validate_rfc_office_page(self) -> str:
-        url = f"https://www.weather.gov/{self.rfc_alias.lower()}rfc"
-        resp = requests.get(url, allow_redirects=True)
-        if resp.ok:
-            return url
-        else:
-            logging.error(f"rfc homepage url {url} not valid")
-            raise requests.exceptions.RequestException
+
+class ListingState:
+    """Records the ETag and last modified time of each listed mirror object, so later incremental runs can skip
+    objects which are unchanged since the run which documented them without requesting their metadata"""
+
+    def __init__(self, previous: dict[str, list[str]] | None = None) -> None:
+        self.previous = previous or {}
+        self.current = dict()
+
+    def is_changed(self, content: dict) -> bool:
+        """Listing filter which records the object version and checks it against the previous run"""
+        key = cast(str, content.get("Key"))
+        version = [cast(str, content.get("ETag")), cast(datetime.datetime, content.get("LastModified")).isoformat()]
+        self.current[key] = version
+        return self.previous.get(key) != version
+
+    @classmethod
+    def load(cls, bucket: str, key: str, client: Any | None = None) -> "ListingState":
+        try:
+            body = get_object_body_string(bucket, key, client).read()
+        except ClientError as exc:
+            if exc.response.get("Error", {}).get("Code") not in ("NoSuchKey", "404"):
+                raise
+            logging.info(f"No listing state found at s3://{bucket}/{key}, all objects will be checked")
+            return cls()
+        return cls(json.loads(body))
+
+    def save(self, bucket: str, key: str, client: Any | None = None) -> None:
+        put_object_body(bucket, key, json.dumps(self.current).encode("utf-8"), "application/json", client)
+        logging.info(f"Listing state for {len(self.current)} objects saved to s3://{bucket}/{key}")
 
 
 class NodeNamer:
     def __init__(self) -> None:
         self.name_set = set()
 
-    def __verify_name(self, new_name: str) -> None:
+    @staticmethod
+    def source_name(source_uri: str) -> str:
+        return source_uri.rpartition("/")[2].removesuffix(".zip")
+
+    def seed(self, graph: rdflib.Graph) -> None:
+        """Registers source dataset names already documented in a graph"""
+        for source_distribution_uri in graph.subjects(RDF.type, AORC.SourceDistribution):
+            self.name_set.add(self.source_name(str(source_distribution_uri)))
+
+    def __register_name(self, new_name: str) -> bool:
         if new_name in self.name_set:
-            logging.error("Duplicate name already exists: {0}".format(new_name))
-            raise ValueError
+            return False
         self.name_set.add(new_name)
+        return True
 
-    def name_source_ds(self, meta: CompletedTransferMetadata) -> str:
-        fn_index = meta.source_uri.rfind("/") + 1
-        fn = meta.source_uri[fn_index:].replace(".zip", "")
-        self.__verify_name(fn)
+    def name_source_ds(self, meta: CompletedTransferMetadata) -> str | None:
+        fn = meta.source_basename
+        if not self.__register_name(fn):
+            logging.error("Duplicate name already exists, skipping: {0}".format(fn))
+            return None
         return fn
 
     def name_ds_period(self, meta: CompletedTransferMetadata) -> str:
@@ -135,9 +394,7 @@ class NodeNamer:
         return name
 
     def name_transfer(self, meta: CompletedTransferMetadata):
-        fn_index = meta.source_uri.rfind("/") + 1
-        fn = meta.source_uri[fn_index:].replace(".zip", "")
-        name = f"{meta.mirror_script}_{fn}"
+        name = f"{meta.mirror_script}_{meta.source_basename}"
         return name
 
 
@@ -154,6 +411,62 @@ def complete_metadata(mirror_object: dict) -> CompletedTransferMetadata | None:
         return None
 
 
+def get_new_metadata(
+    mirror_objects: Iterable[dict], existing_names: set[str], workers: int = 32, max_pending: int = 64
+) -> Generator[CompletedTransferMetadata, None, None]:
+    """Completes metadata for mirror objects which are not documented yet, yielding them in the order received
+
+    Args:
+        mirror_objects (Iterable[dict]): s3 object metadata of mirrored files
+        existing_names (set[str]): Source dataset names which are already documented
+        workers (int, optional): Threads completing metadata, which waits on RFC page validation. Defaults to 32.
+        max_pending (int, optional): Maximum number of objects being completed ahead of the consumer. Defaults to 64.
+
+    Yields:
+        Generator[CompletedTransferMetadata, None, None]: Completed metadata
+    """
+    def is_new(mirror_object: dict) -> bool:
+        # Checked against the raw metadata so existing objects skip validation requests and date parsing
+        source_uri = cast(dict, mirror_object.get("Metadata")).get("source_uri")
+        if source_uri and NodeNamer.source_name(source_uri) in existing_names:
+            logging.info(f"Skipping {mirror_object.get('Key')}, source dataset already documented")
+            return False
+        return True
+
+    for meta in map_ahead(complete_metadata, filter(is_new, mirror_objects), workers, max_pending):
+        if meta:
+            yield meta
+
+
+def build_ntriples_batch(
+    metas: list[CompletedTransferMetadata], filter: AORCFilter | None, stream: bool = False
+) -> list[tuple[str | None, bytes]]:
+    """Worker function which creates triples for a batch of metadata objects in its own graphs
+
+    Args:
+        metas (list[CompletedTransferMetadata]): Completed metadata for the batch of mirrored objects
+        filter (AORCFilter | None): Filter used to partition graphs
+        stream (bool, optional): If True, write the batch with NTriplesSink so blank node labels are escaped the
+            same way as the streamed graph it is appended to. Defaults to False.
+
+    Returns:
+        list[tuple[str | None, bytes]]: Filter key and N-Triples serialization of each graph created for the batch
+    """
+    graph_creator = GraphCreator(NS_PREFIXES, stream)
+    namer = NodeNamer()
+    for meta in metas:
+        create_graph_triples(meta, graph_creator, namer, filter)
+    batch = []
+    for key, g in graph_creator.iter_graphs():
+        if isinstance(g, NTriplesSink):
+            g.fileobj.seek(0)
+            batch.append((key, g.fileobj.read()))
+            g.close()
+        else:
+            batch.append((key, g.serialize(format="nt", encoding="utf-8")))
+    return batch
+
+
 def construct_mirror_graph(
     mirror_bucket: str,
     mirror_prefix: str,
@@ -161,15 +474,56 @@ def construct_mirror_graph(
     filter: AORCFilter | None = AORCFilter.RFC,
     client: Any | None = None,
     target_bucket: str | None = None,
+    processes: int | None = None,
+    batch_size: int = 500,
+    stream: bool = False,
+    incremental: bool = False,
+    state_key: str | None = None,
 ) -> None:
-    ns_prefixes = {"dcat": DCAT, "prov": PROV, "dct": DCTERMS, "aorc": AORC}
-    graph_creator = GraphCreator(ns_prefixes)
+    if stream and rdf_format(filepath_pattern) not in ("nt", "turtle"):
+        raise ValueError(f"Streamed graphs are written as N-Triples, cannot write to {filepath_pattern}")
+    graph_creator = GraphCreator(NS_PREFIXES, stream)
     namer = NodeNamer()
-    for object in get_s3_content(mirror_bucket, mirror_prefix, True, client):
-        meta = complete_metadata(object)
-        if meta:
+    # Build onto output from a previous run, skipping objects which are already documented
+    if incremental:
+        for existing_graph in graph_creator.load_existing(filepath_pattern, True, client, target_bucket):
+            namer.seed(existing_graph)
+    # Versions of listed objects are kept in target bucket at state_key, incremental runs skip unchanged objects
+    state = None
+    if state_key and target_bucket:
+        state = ListingState.load(target_bucket, state_key, client) if incremental else ListingState()
+    # s3 requests and metadata completion run in a background thread while triples are created,
+    # with the mirror listed in parallel across its sub-prefixes (ie one per RFC)
+    mirror_objects = get_s3_content_parallel(
+        mirror_bucket, mirror_prefix, True, client, listing_filter=state.is_changed if state else None
+    )
+    metas = prefetch(get_new_metadata(mirror_objects, namer.name_set))
+    if not processes:
+        for meta in metas:
             create_graph_triples(meta, graph_creator, namer, filter)
+    else:
+        # Triple creation has no cross object dependencies, so batches are built in worker processes and merged
+        futures: list[Future] = []
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            batch = []
+            for meta in metas:
+                # Names are verified in the parent process since each worker only sees its own batch
+                if namer.name_source_ds(meta) is None:
+                    continue
+                batch.append(meta)
+                if len(batch) >= batch_size:
+                    futures.append(executor.submit(build_ntriples_batch, batch, filter, stream))
+                    batch = []
+            if batch:
+                futures.append(executor.submit(build_ntriples_batch, batch, filter, stream))
+            for future in futures:
+                for filter_key, ntriples in future.result():
+                    graph_creator.merge_ntriples(filter_key, ntriples)
+        logging.info(f"Merged graphs from {len(futures)} batches")
     graph_creator.serialize_graphs(filepath_pattern, True, client, target_bucket)
+    # Only saved once the graphs documenting the listed objects have been written
+    if state and state_key and target_bucket:
+        state.save(target_bucket, state_key, client)
 
 
 def create_graph_triples(
@@ -182,92 +536,99 @@ def create_graph_triples(
             filter_value = meta.ref_date[:4]
         elif filter.name == "RFC":
             filter_value = meta.rfc_alias
+    # Skip objects whose source dataset has already been documented
+    source_dataset_name = node_namer.name_source_ds(meta)
+    if source_dataset_name is None:
+        return
     g = graph_creator.get_graph(filter_value)
+    # Triples are collected as quads and added in one batch
+    triples = []
+    add = triples.append
 
     # Create source dataset instance, properties
-    source_dataset_node = BNode(node_namer.name_source_ds(meta))
-    g.add((source_dataset_node, RDF.type, AORC.SourceDataset))
+    source_dataset_node = BNode(source_dataset_name)
+    add((source_dataset_node, RDF.type, AORC.SourceDataset, g))
     source_dataset_period_of_time_node = BNode(node_namer.name_ds_period(meta))
-    g.add((source_dataset_period_of_time_node, RDF.type, DCTERMS.PeriodOfTime))
-    g.add((source_dataset_node, DCTERMS.temporal, source_dataset_period_of_time_node))
-    source_dataset_period_start = Literal(meta.ref_date, datatype=XSD.date)
-    g.add((source_dataset_period_of_time_node, DCAT.startDate, source_dataset_period_start))
-    source_dataset_period_end = Literal(meta.ref_end_date, datatype=XSD.date)
-    g.add((source_dataset_period_of_time_node, DCAT.endDate, source_dataset_period_end))
+    add((source_dataset_node, DCTERMS.temporal, source_dataset_period_of_time_node, g))
+    # Periods, scripts, docker images, RFC offices, and precip partitions are shared by many records,
+    # so they are only described the first time they appear in each graph
+    if graph_creator.mark_emitted(filter_value, source_dataset_period_of_time_node):
+        add((source_dataset_period_of_time_node, RDF.type, DCTERMS.PeriodOfTime, g))
+        source_dataset_period_start = date_literal(meta.ref_date)
+        add((source_dataset_period_of_time_node, DCAT.startDate, source_dataset_period_start, g))
+        source_dataset_period_end = date_literal(meta.ref_end_date)
+        add((source_dataset_period_of_time_node, DCAT.endDate, source_dataset_period_end, g))
 
     # Create source dataset distribution instance, properties
-    source_distribution_uri = URIRef(
-        "".join([meta.aorc_historic_uri, meta.rfc_catalog_uri, meta.precip_partition_uri, meta.source_uri])
-    )
-    g.add((source_distribution_uri, RDF.type, AORC.SourceDistribution))
+    source_distribution_uri = URIRef(meta.source_distribution_url)
+    add((source_distribution_uri, RDF.type, AORC.SourceDistribution, g))
     source_distribution_byte_size = Literal(meta.source_bytes, datatype=XSD.positiveInteger)
-    g.add((source_distribution_uri, DCAT.byteSize, source_distribution_byte_size))
+    add((source_distribution_uri, DCAT.byteSize, source_distribution_byte_size, g))
     source_last_modified = Literal(meta.source_last_modified, datatype=XSD.dateTime)
-    g.add((source_distribution_uri, DCTERMS.modified, source_last_modified))
-    zip_compression = URIRef("https://www.iana.org/assignments/media-types/application/zip")
-    g.add((source_distribution_uri, DCAT.compressFormat, zip_compression))
-    netcdf_format = URIRef("https://publications.europa.eu/resource/authority/file-type/NETCDF")
-    g.add((source_distribution_uri, DCAT.packageFormat, netcdf_format))
-    monthly_frequency = URIRef("http://purl.org/cld/freq/monthly")
-    g.add((source_dataset_node, DCTERMS.accrualPeriodicity, monthly_frequency))
+    add((source_distribution_uri, DCTERMS.modified, source_last_modified, g))
+    add((source_distribution_uri, DCAT.compressFormat, ZIP_COMPRESSION, g))
+    add((source_distribution_uri, DCAT.packageFormat, NETCDF_FORMAT, g))
+    add((source_dataset_node, DCTERMS.accrualPeriodicity, MONTHLY_FREQUENCY, g))
 
     # Associate distribution with dataset
-    g.add((source_dataset_node, DCAT.distribution, source_distribution_uri))
+    add((source_dataset_node, DCAT.distribution, source_distribution_uri, g))
 
     # Create mirror dataset instance, properties
     mirror_dataset_uri = URIRef(meta.mirror_uri)
-    g.add((mirror_dataset_uri, RDF.type, AORC.MirrorDataset))
+    add((mirror_dataset_uri, RDF.type, AORC.MirrorDataset, g))
     mirror_last_modified = Literal(meta.mirror_last_modified, datatype=XSD.dateTime)
-    g.add((mirror_dataset_uri, DCTERMS.created, mirror_last_modified))
-    access_description = Literal(
-        "Access is restricted based on users credentials for AWS bucket holding data", datatype=XSD.string
-    )
-    g.add((mirror_dataset_uri, OWL.Annotation, access_description))
+    add((mirror_dataset_uri, DCTERMS.created, mirror_last_modified, g))
+    add((mirror_dataset_uri, OWL.Annotation, ACCESS_DESCRIPTION, g))
 
     # Associate mirror dataset with source dataset
-    g.add((mirror_dataset_uri, AORC.hasSourceDataset, source_dataset_node))
+    add((mirror_dataset_uri, AORC.hasSourceDataset, source_dataset_node, g))
 
     # Create mirror distribution instance, properties
     mirror_distribution_uri = URIRef(meta.mirror_public_uri)
-    g.add((mirror_distribution_uri, RDF.type, AORC.MirrorDistribution))
+    add((mirror_distribution_uri, RDF.type, AORC.MirrorDistribution, g))
 
     # Associate mirror distribution with mirror dataset
-    g.add((mirror_dataset_uri, DCAT.distribution, mirror_distribution_uri))
+    add((mirror_dataset_uri, DCAT.distribution, mirror_distribution_uri, g))
 
     # Create transfer script instance
     script_node = BNode(meta.mirror_script)
-    g.add((script_node, RDF.type, AORC.TransferScript))
-    g.add((script_node, DCTERMS.identifier, Literal(meta.mirror_script)))
+    if graph_creator.mark_emitted(filter_value, script_node):
+        add((script_node, RDF.type, AORC.TransferScript, g))
+        add((script_node, DCTERMS.identifier, plain_literal(meta.mirror_script), g))
 
     # Create docker image instance, properties
-    docker_image_uri = URIRef(meta.docker_image_url)
-    g.add((docker_image_uri, RDF.type, AORC.DockerImage))
-    g.add((docker_image_uri, AORC.hasTransferScript, script_node))
+    docker_image_uri = cached_uri(meta.docker_image_url)
+    if graph_creator.mark_emitted(filter_value, (docker_image_uri, script_node)):
+        add((docker_image_uri, RDF.type, AORC.DockerImage, g))
+        add((docker_image_uri, AORC.hasTransferScript, script_node, g))
 
     # Create transfer job activity instance, properties
     transfer_job_node = BNode(node_namer.name_transfer(meta))
-    g.add((transfer_job_node, RDF.type, AORC.TransferJob))
-    g.add((transfer_job_node, AORC.transferred, mirror_dataset_uri))
-    g.add((transfer_job_node, PROV.used, source_dataset_node))
-    g.add((transfer_job_node, PROV.wasStartedBy, script_node))
+    add((transfer_job_node, RDF.type, AORC.TransferJob, g))
+    add((transfer_job_node, AORC.transferred, mirror_dataset_uri, g))
+    add((transfer_job_node, PROV.used, source_dataset_node, g))
+    add((transfer_job_node, PROV.wasStartedBy, script_node, g))
 
     # Create RFC office instance
-    rfc_office_uri = URIRef(meta.rfc_office_uri)
-    g.add((rfc_office_uri, RDF.type, AORC.RFC))
-    rfc_office_title = Literal(meta.rfc_name, datatype=XSD.string)
-    g.add((rfc_office_uri, AORC.hasRFCName, rfc_office_title))
-    rfc_office_alias = Literal(meta.rfc_alias, datatype=XSD.string)
-    g.add((rfc_office_uri, AORC.hasRFCAlias, rfc_office_alias))
+    rfc_office_uri = cached_uri(meta.rfc_office_uri)
+    if graph_creator.mark_emitted(filter_value, (rfc_office_uri, meta.rfc_name, meta.rfc_alias)):
+        add((rfc_office_uri, RDF.type, AORC.RFC, g))
+        rfc_office_title = str_literal(meta.rfc_name)
+        add((rfc_office_uri, AORC.hasRFCName, rfc_office_title, g))
+        rfc_office_alias = str_literal(meta.rfc_alias)
+        add((rfc_office_uri, AORC.hasRFCAlias, rfc_office_alias, g))
 
     # Create precip partition catalog instance, properties
-    precip_partition_uri = URIRef("".join([meta.aorc_historic_uri, meta.rfc_catalog_uri, meta.precip_partition_uri]))
-    precip_keyword_uri = Literal("precipitation", datatype=XSD.string)
-    g.add((precip_partition_uri, RDF.type, AORC.PrecipPartition))
-    g.add((precip_partition_uri, DCAT.keyword, precip_keyword_uri))
-    g.add((precip_partition_uri, AORC.hasRFC, rfc_office_uri))
+    precip_partition_uri = cached_uri(meta.precip_partition_url)
+    if graph_creator.mark_emitted(filter_value, (precip_partition_uri, rfc_office_uri)):
+        add((precip_partition_uri, RDF.type, AORC.PrecipPartition, g))
+        add((precip_partition_uri, DCAT.keyword, PRECIP_KEYWORD, g))
+        add((precip_partition_uri, AORC.hasRFC, rfc_office_uri, g))
 
     # Associate precip partition catalog with source dataset it holds
-    g.add((precip_partition_uri, DCAT.dataset, source_dataset_node))
+    add((precip_partition_uri, DCAT.dataset, source_dataset_node, g))
+
+    g.addN(triples)
 
 
 if __name__ == "__main__":
@@ -277,5 +638,5 @@ if __name__ == "__main__":
     client = get_client()
     set_up_logger(level=logging.INFO)
     construct_mirror_graph(
-        "tempest", "mirrors/aorc/precip", "graphs/aorc/test/{0}.ttl", AORCFilter.RFC, client, "tempest"
+        "tempest", "mirrors/aorc/precip", "graphs/aorc/test/{0}.nt", AORCFilter.RFC, client, "tempest", stream=True
     )
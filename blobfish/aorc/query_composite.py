@@ -1,41 +1,73 @@
 """ Script to test SPARQL query ease of use for retrieving metadata """
 import datetime
+import functools
+import logging
+import os
 import rdflib
+from rdflib.plugins.sparql import prepareQuery
 from ..pyrdf import AORC
+from ..utils.rdf_format import rdf_format
+
+logger = logging.getLogger(__name__)
+
+# Parsed once at import, calls only bind the time range and evaluate
+COMPOSITES_TIME_RANGE_QUERY = prepareQuery(
+    """
+    SELECT  ?cdata ?sdist
+    WHERE {
+        ?cdata rdf:type aorc:CompositeDataset .
+        ?cdata aorc:isCompositeOf ?mdata .
+        ?mdata aorc:hasSourceDataset ?sdata .
+        ?sdata dcat:distribution ?sdist .
+        ?cdata dct:temporal ?t .
+        ?t dcat:startDate ?stdate .
+        ?t dcat:endDate ?edate .
+        FILTER (?st <= ?stdate && ?et >= ?edate)
+    }
+    """,
+    initNs={"rdf": rdflib.RDF, "aorc": AORC, "dcat": rdflib.DCAT, "dct": rdflib.DCTERMS, "xsd": rdflib.XSD},
+)
 
 
 def create_graph(ttl: str) -> rdflib.Graph:
     g = rdflib.Graph()
-    g.parse(ttl)
+    if rdf_format(ttl) != "turtle" or not os.path.exists(ttl):
+        g.parse(ttl)
+        return g
+    # Turtle is converted once to an N-Triples sidecar, which is much cheaper to parse on later loads
+    sidecar = f"{ttl}.nt"
+    if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(ttl):
+        g.parse(sidecar, format="nt")
+        return g
+    g.parse(ttl, format="turtle")
+    try:
+        g.serialize(sidecar, format="nt", encoding="utf-8")
+    except OSError:
+        logger.warning("Could not write N-Triples sidecar %s, %s will be parsed again on the next load", sidecar, ttl)
     return g
 
 
+@functools.lru_cache(maxsize=8)
+def load_graph(ttl: str, mtime: float | None) -> rdflib.Graph:
+    """Parses a graph once per file version, mtime is part of the cache key so an edited file is parsed again"""
+    return create_graph(ttl)
+
+
 def get_composites_time_range(
     ttl: str, start_time: datetime.datetime, end_time: datetime.datetime
 ) -> rdflib.query.Result:
-    graph = create_graph(ttl)
     """Gets composite datasets which have a temporal coverage which falls within the start and end time. Also gets the distribution URLS of the source datasets used to create the composite dataset.
 
     Args:
+        ttl (str): Path or url of composite graph
         start_time (datetime.datetime): Start of period of interest
         end_time (datetime.datetime): End of period of interest
     """
-    query = """
-    SELECT  ?cdata ?sdist
-    WHERE {
-        ?cdata rdf:type aorc:CompositeDataset .
-        ?cdata aorc:isCompositeOf ?mdata .
-        ?mdata aorc:hasSourceDataset ?sdata .
-        ?sdata dcat:distribution ?sdist .
-        ?cdata dct:temporal ?t .
-        ?t dcat:startDate ?stdate .
-        ?t dcat:endDate ?edate .
-        FILTER (?st <= ?stdate && ?et >= ?edate)
-    }
-    """
+    # Remote graphs have no modification time to check so are cached for the life of the process
+    mtime = os.path.getmtime(ttl) if os.path.exists(ttl) else None
+    graph = load_graph(ttl, mtime)
     result = graph.query(
-        query,
-        initNs={"rdf": rdflib.RDF, "aorc": AORC, "dcat": rdflib.DCAT, "dct": rdflib.DCTERMS, "xsd": rdflib.XSD},
+        COMPOSITES_TIME_RANGE_QUERY,
         initBindings={"st": rdflib.Literal(start_time.isoformat(), datatype=rdflib.XSD.dateTime), "et": rdflib.Literal(end_time.isoformat(), datatype=rdflib.XSD.dateTime)}
     )
     return result
@@ -1,25 +1,27 @@
 """ Script to handle transfer of data from FTP server to s3 with appropriate metadata """
 
-import requests
 import warnings
 import datetime
 import boto3
 import os
-import sys
 import logging
 import asyncio
+import functools
+import itertools
+import random
 import tempfile
-from aiohttp import ClientSession, ServerDisconnectedError, StreamReader
-from aiofile import async_open
-from typing import List, Tuple, cast
+from aiohttp import ClientConnectionError, ClientResponseError, ClientSession, ClientTimeout, StreamReader, TCPConnector
+from typing import IO, Generator, List, Tuple
 from boto3.resources.factory import ServiceResource
 from dateutil.relativedelta import relativedelta
 from dataclasses import dataclass, asdict, field
 
 from .const import RFC_INFO_LIST, RFCInfo, FIRST_RECORD, FTP_HOST
 
+logger = logging.getLogger(__name__)
 
-@dataclass
+
+@dataclass(slots=True)
 class SourceURLObject:
     rfc_catalog_relative_url: str
     precip_partition_relative_url: str
@@ -28,7 +30,7 @@ class SourceURLObject:
     rfc: RFCInfo
 
 
-@dataclass
+@dataclass(slots=True)
 class BaseTransferMetadata:
     """Class to package metadata available using presumed FTP structure and information provided to TransferHandler object"""
 
@@ -48,7 +50,7 @@ class BaseTransferMetadata:
         self.aorc_historic_uri = FTP_HOST
 
 
-@dataclass
+@dataclass(slots=True)
 class TransferMetadata(BaseTransferMetadata):
     """Class to package metadata available after the source file has been queried with an HTTP request"""
 
@@ -57,10 +59,41 @@ class TransferMetadata(BaseTransferMetadata):
     source_bytes: str
 
 
-@dataclass
+@dataclass(slots=True)
 class TransferContext:
     relative_mirror_uri: str
     metadata: BaseTransferMetadata
+    metadata_dict: dict = field(init=False)
+
+    def __post_init__(self):
+        # Serialized once, only the source response headers vary per upload
+        self.metadata_dict = asdict(self.metadata)
+
+    def transfer_metadata(self, last_modified: str, content_length: str) -> dict:
+        """Gets upload metadata with the same fields as TransferMetadata without building and serializing one"""
+        return {**self.metadata_dict, "source_last_modified": last_modified, "source_bytes": content_length}
+
+
+# Size of each multipart upload part when streaming source files, s3 requires at least 5 MB for all but the last part
+STREAM_PART_SIZE = 8 * 1024 * 1024
+
+
+# Buffered transfers read the body in DOWNLOAD_CHUNK_SIZE pieces, spilling to disk past DOWNLOAD_SPOOL_SIZE
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_SPOOL_SIZE = 16 * 1024 * 1024
+
+# Retries back off exponentially from RETRY_BASE seconds up to RETRY_CAP,
+# with jitter so transfers which failed together do not all retry in lockstep
+RETRY_BASE = 0.25
+RETRY_CAP = 30
+RETRY_JITTER = 1.0
+
+# No limit on total transfer time for large files, only on connecting and on a stalled read
+REQUEST_TIMEOUT = ClientTimeout(total=None, sock_connect=10, sock_read=60)
+
+
+def retry_delay(retries: int) -> float:
+    return min(RETRY_CAP, RETRY_BASE * 2**retries) + random.uniform(0, RETRY_JITTER)
 
 
 class FTPError(Exception):
@@ -68,11 +101,16 @@ class FTPError(Exception):
 
 
 def get_sessioned_s3_resource() -> ServiceResource:
-    """Utility function to get an s3 resource with its own session
+    """Utility function to get an s3 resource with its own session, built once per process and shared by handlers
 
     Returns:
         boto3.resources.factory.ServiceResource: s3 resource
     """
+    return _get_process_s3_resource(os.getpid())
+
+
+@functools.lru_cache(maxsize=None)
+def _get_process_s3_resource(pid: int) -> ServiceResource:
     # locally this will work. batch will not have these env variables
     try:
         session = boto3.Session(
@@ -109,6 +147,9 @@ class TransferHandler:
         self.resource = get_sessioned_s3_resource()
         # Assign properties
         self.mirror_bucket_name = mirror_bucket_name
+        # Bucket handle and low level client are built once and shared by every transfer
+        self.mirror_bucket = self.resource.Bucket(mirror_bucket_name)
+        self.s3_client = self.resource.meta.client
         self.mirror_file_prefix = mirror_file_prefix
         self.docker_image_url = tagged_docker_image
         self.rfc_list = rfc_list
@@ -126,69 +167,73 @@ class TransferHandler:
                 message=".*Unverified HTTPS request is being made to host 'hydrology.nws.noaa.gov'.*",
             )
 
-    def __verify(self) -> None:
-        directory_template_url = "AORC_{0}RFC_4km/{0}RFC_precip_partition/"
-        for rfc in self.rfc_list:
-            verify = not self.dev
-            directory_formatted_url = f"{FTP_HOST}/{directory_template_url.format(rfc.alias)}"
-            with requests.head(directory_formatted_url, verify=verify) as resp:
-                if resp.status_code != 200:
-                    raise FTPError
-        logging.info("expected file structure of FTP server verified")
-
-    def __create_url_list(self) -> List[SourceURLObject]:
-        urls = []
+    async def __verify(self, rfc: RFCInfo, session: ClientSession) -> bool:
+        """Checks the expected FTP directory of an RFC once per run, shared by all of that RFC's transfers"""
+        check = self.directory_checks.get(rfc.alias)
+        if check is None:
+            check = asyncio.ensure_future(self.__check_directory(rfc, session))
+            self.directory_checks[rfc.alias] = check
+        return await check
+
+    async def __check_directory(self, rfc: RFCInfo, session: ClientSession) -> bool:
+        directory_formatted_url = f"{FTP_HOST}/AORC_{rfc.alias}RFC_4km/{rfc.alias}RFC_precip_partition/"
+        try:
+            async with session.head(directory_formatted_url, ssl=not self.dev, raise_for_status=False) as resp:
+                verified = resp.status == 200
+        except (ClientConnectionError, asyncio.TimeoutError):
+            verified = False
+        if verified:
+            logger.info("expected file structure of FTP server verified for %sRFC", rfc.alias)
+        else:
+            logger.error("expected file structure of FTP server not found for %sRFC, skipping its files", rfc.alias)
+        return verified
+
+    def __iter_url_list(self) -> Generator[SourceURLObject, None, None]:
         rfc_catalog_url = "/AORC_{0}RFC_4km"
         precip_partition_url = "/{0}RFC_precip_partition"
         source_file_url = "/AORC_APCP_4KM_{0}RFC_{1}.zip"
-        try:
-            self.__verify()
-            for rfc in self.rfc_list:
-                current_datetime = self.start_date
-                while current_datetime <= self.end_date:
-                    urls.append(
-                        SourceURLObject(
-                            rfc_catalog_url.format(rfc.alias),
-                            precip_partition_url.format(rfc.alias),
-                            source_file_url.format(rfc.alias, current_datetime.strftime("%Y%m")),
-                            current_datetime,
-                            rfc,
-                        )
-                    )
-                    current_datetime += relativedelta(months=1)
-                    if self.limit and len(urls) >= self.limit:
-                        break
-                if self.limit and len(urls) >= self.limit:
-                    break
-        except FTPError:
-            logging.error("expected file structure of FTP server was not verified")
-            sys.exit(1)
-        return urls
+        # Months are the same for every RFC, so they are stepped through and formatted once
+        months = []
+        current_datetime = self.start_date
+        while current_datetime <= self.end_date:
+            months.append((current_datetime, f"{current_datetime.year:04d}{current_datetime.month:02d}"))
+            current_datetime += relativedelta(months=1)
+        for rfc in self.rfc_list:
+            rfc_catalog_relative_url = rfc_catalog_url.format(rfc.alias)
+            precip_partition_relative_url = precip_partition_url.format(rfc.alias)
+            for date, year_month in months:
+                yield SourceURLObject(
+                    rfc_catalog_relative_url,
+                    precip_partition_relative_url,
+                    source_file_url.format(rfc.alias, year_month),
+                    date,
+                    rfc,
+                )
 
     async def __get_data(
-        self, url: str, sem: asyncio.BoundedSemaphore, session: ClientSession, stream: bool
-    ) -> Tuple[bytes | StreamReader | None, str | None, str | None]:
+        self, url: str, session: ClientSession, fp: IO[bytes]
+    ) -> Tuple[str | None, str | None]:
+        """Downloads the response body into fp chunk by chunk, returning the Last-Modified and Content-Length headers"""
         retries = 0
         while retries < self.max_retries:
             try:
-                async with sem:
-                    verify = not self.dev
-                    resp = await session.get(url, ssl=verify)
+                async with session.get(url, ssl=not self.dev) as resp:
                     last_modified = resp.headers.get("Last-Modified")
                     content_length = resp.headers.get("Content-Length")
-                    if stream:
-                        return resp.content, last_modified, content_length
-                    data = await resp.read()
-                    return data, last_modified, content_length
-            # If server disconnects, sleep then retry
-            except ServerDisconnectedError:
-                await asyncio.sleep(3)
+                    async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        fp.write(chunk)
+                    return last_modified, content_length
+            except ClientResponseError as exc:
+                logger.error("request for %s failed with status %s", url, exc.status)
+                return None, None
+            # If the connection drops or stalls, back off then retry
+            except (ClientConnectionError, asyncio.TimeoutError):
+                # Drop any partial body before retrying
+                fp.seek(0)
+                fp.truncate()
+                await asyncio.sleep(retry_delay(retries))
                 retries += 1
-        return None, None, None
-
-    async def __write_data(self, data: bytes, file):
-        async with async_open(file, "wb") as outfile:
-            await outfile.write(data)
+        return None, None
 
     def __set_up_transfer(self, url_object: SourceURLObject) -> TransferContext:
         mirror_uri = f"{self.mirror_file_prefix}{url_object.rfc_catalog_relative_url}{url_object.precip_partition_relative_url}{url_object.source_relative_url}"
@@ -200,7 +245,7 @@ class TransferHandler:
             url_object.precip_partition_relative_url,
             url_object.source_relative_url,
             full_mirror_uri,
-            url_object.date.strftime("%Y-%m-%d"),
+            url_object.date.date().isoformat(),
             self.docker_image_url,
             self.script_path,
         )
@@ -210,63 +255,168 @@ class TransferHandler:
     async def __write_out_data(
         self, url_object: SourceURLObject, sem: asyncio.BoundedSemaphore, session: ClientSession
     ):
+        if not await self.__verify(url_object.rfc, session):
+            return
         context = self.__set_up_transfer(url_object)
-        mirror_bucket = self.resource.Bucket(self.mirror_bucket_name)
-        with tempfile.TemporaryFile() as fp:
-            full_url = f"{context.metadata.aorc_historic_uri}{url_object.rfc_catalog_relative_url}{url_object.precip_partition_relative_url}{url_object.source_relative_url}"
-            data, last_modified, content_length = await self.__get_data(full_url, sem, session, stream=False)
-            if data and last_modified and content_length:
-                await self.__write_data(cast(bytes, data), fp)
-                context_meta_dict = asdict(context.metadata)
-                context_meta_dict["source_bytes"] = content_length
-                context_meta_dict["source_last_modified"] = last_modified
-                transfer_metadata = TransferMetadata(**context_meta_dict)
-                mirror_bucket.upload_fileobj(
-                    fp, context.relative_mirror_uri, ExtraArgs={"Metadata": asdict(transfer_metadata)}
-                )
-                logging.info(f"data from {full_url} successfully transferred to {transfer_metadata.mirror_uri}")
-            elif last_modified and content_length:
-                logging.error(f"tried to transfer data for {full_url}, received no data")
-            else:
-                logging.error(f"tried to transfer data for {full_url}, could not parse content headers")
+        full_url = f"{context.metadata.aorc_historic_uri}{url_object.rfc_catalog_relative_url}{url_object.precip_partition_relative_url}{url_object.source_relative_url}"
+        # The slot is held until the upload finishes, bounding the spooled bodies waiting on the thread pool
+        async with sem:
+            # Body is spooled in memory up to DOWNLOAD_SPOOL_SIZE and to disk past it, bounding memory per transfer
+            with tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_SIZE) as fp:
+                last_modified, content_length = await self.__get_data(full_url, session, fp)
+                if fp.tell() and last_modified and content_length:
+                    fp.seek(0)
+                    # boto3 uploads block, so they run in the default thread pool while other downloads keep going
+                    await asyncio.get_running_loop().run_in_executor(
+                        None,
+                        functools.partial(
+                            self.mirror_bucket.upload_fileobj,
+                            fp,
+                            context.relative_mirror_uri,
+                            ExtraArgs={"Metadata": context.transfer_metadata(last_modified, content_length)},
+                        ),
+                    )
+                    logger.info("data from %s successfully transferred to %s", full_url, context.metadata.mirror_uri)
+                elif last_modified and content_length:
+                    logger.error("tried to transfer data for %s, received no data", full_url)
+                else:
+                    logger.error("tried to transfer data for %s, could not parse content headers", full_url)
 
-    """
-    Commenting out __stream_out_data() because it would require reworking script to use a version of boto which supports async syntax
-    """
-    # async def __stream_out_data(
-    #     self, url_object: SourceURLObject, sem: asyncio.BoundedSemaphore, session: ClientSession
-    # ):
-    #     context = self.__set_up_transfer(url_object)
-    #     mirror_bucket = self.resource.Bucket(self.mirror_bucket_name)
-    #     data = await self.__get_data(url_object.url, sem, session, stream=True)
-    #     if data:
-    #         print("data received")
-    #         mirror_bucket.upload_fileobj(
-    #             data, context.relative_mirror_uri, ExtraArgs={"Metadata": asdict(context.metadata)}
-    #         )
-    #         logging.info(f"data from {url_object.url} successfully transferred to {context.metadata.mirror_uri}")
-    #     else:
-    #         logging.error(f"tried to transfer data for {url_object.url}, received no data")
+    async def __stream_out_data(
+        self, url_object: SourceURLObject, sem: asyncio.BoundedSemaphore, session: ClientSession
+    ):
+        if not await self.__verify(url_object.rfc, session):
+            return
+        context = self.__set_up_transfer(url_object)
+        loop = asyncio.get_running_loop()
+        full_url = f"{context.metadata.aorc_historic_uri}{url_object.rfc_catalog_relative_url}{url_object.precip_partition_relative_url}{url_object.source_relative_url}"
+        async with sem:
+            retries = 0
+            while retries < self.max_retries:
+                try:
+                    async with session.get(full_url, ssl=not self.dev) as resp:
+                        last_modified = resp.headers.get("Last-Modified")
+                        content_length = resp.headers.get("Content-Length")
+                        if not (last_modified and content_length):
+                            logger.error("tried to transfer data for %s, could not parse content headers", full_url)
+                            return
+                        part_count = await self.__upload_stream(
+                            self.s3_client,
+                            loop,
+                            resp.content,
+                            context.relative_mirror_uri,
+                            context.transfer_metadata(last_modified, content_length),
+                        )
+                    if part_count:
+                        logger.info("data from %s successfully streamed to %s", full_url, context.metadata.mirror_uri)
+                    else:
+                        logger.error("tried to transfer data for %s, received no data", full_url)
+                    return
+                except ClientResponseError as exc:
+                    logger.error("tried to transfer data for %s, request failed with status %s", full_url, exc.status)
+                    return
+                # If the connection drops or stalls, back off then retry
+                except (ClientConnectionError, asyncio.TimeoutError):
+                    await asyncio.sleep(retry_delay(retries))
+                    retries += 1
+            logger.error("tried to transfer data for %s, connection failed %s times", full_url, retries)
+
+    async def __upload_stream(
+        self, client, loop: asyncio.AbstractEventLoop, content: StreamReader, key: str, metadata: dict
+    ) -> int:
+        """Pipes a response body into an s3 multipart upload one part at a time, never holding the whole file in memory
+
+        Returns:
+            int: Number of parts uploaded, 0 if the response had no body and the upload was aborted
+        """
+        upload = await loop.run_in_executor(
+            None,
+            functools.partial(
+                client.create_multipart_upload, Bucket=self.mirror_bucket_name, Key=key, Metadata=metadata
+            ),
+        )
+        upload_id = upload["UploadId"]
+        parts = []
+        buffer = bytearray()
+
+        async def upload_part(body: bytes) -> None:
+            part_number = len(parts) + 1
+            resp = await loop.run_in_executor(
+                None,
+                functools.partial(
+                    client.upload_part,
+                    Bucket=self.mirror_bucket_name,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=part_number,
+                    Body=body,
+                ),
+            )
+            parts.append({"PartNumber": part_number, "ETag": resp["ETag"]})
+
+        abort = functools.partial(
+            client.abort_multipart_upload, Bucket=self.mirror_bucket_name, Key=key, UploadId=upload_id
+        )
+        try:
+            async for chunk in content.iter_chunked(STREAM_PART_SIZE):
+                buffer += chunk
+                # Every part except the last must meet the s3 minimum part size
+                if len(buffer) >= STREAM_PART_SIZE:
+                    await upload_part(bytes(buffer))
+                    buffer.clear()
+            if buffer:
+                await upload_part(bytes(buffer))
+        except BaseException:
+            # Incomplete uploads keep their parts stored until aborted
+            await loop.run_in_executor(None, abort)
+            raise
+        if not parts:
+            await loop.run_in_executor(None, abort)
+            return 0
+        await loop.run_in_executor(
+            None,
+            functools.partial(
+                client.complete_multipart_upload,
+                Bucket=self.mirror_bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            ),
+        )
+        return len(parts)
 
     async def __gather_download_tasks(self, stream: bool) -> List[str]:
-        url_objects = self.__create_url_list()
         tasks = []
+        # Bounds whole transfers (download and upload), the connector below only bounds open sockets
         sem = asyncio.BoundedSemaphore(self.semaphore_size)
-        async with ClientSession() as session:
-            for url_object in url_objects:
+        # Each RFC directory is checked by the first of its transfers to run, futures are bound to this run's loop
+        self.directory_checks: dict[str, asyncio.Future] = {}
+        # Connection pool is sized to the transfer concurrency so every task reuses a kept alive connection to the
+        # FTP host whose address is resolved once.
+        # Error statuses raise rather than having an error page mirrored in place of the source file
+        connector = TCPConnector(
+            limit=self.semaphore_size,
+            limit_per_host=self.semaphore_size,
+            ttl_dns_cache=600,
+            keepalive_timeout=75,
+            enable_cleanup_closed=True,
+            ssl=not self.dev,
+        )
+        async with ClientSession(connector=connector, raise_for_status=True, timeout=REQUEST_TIMEOUT) as session:
+            # Tasks are created as urls are generated rather than after the full list is built
+            # A limit of None (or 0) transfers every url
+            for url_object in itertools.islice(self.__iter_url_list(), self.limit or None):
                 if stream:
-                    print("Streaming from aiohttp content to boto3 file upload is not supported")
-                    raise NotImplementedError
-                    # task = asyncio.create_task(self.__stream_out_data(url_object, sem, session))
+                    task = asyncio.create_task(self.__stream_out_data(url_object, sem, session))
                 else:
                     task = asyncio.create_task(self.__write_out_data(url_object, sem, session))
                 tasks.append(task)
-                logging.info(f"async task created to mirror data from {url_object.source_relative_url}")
+                logger.info("async task created to mirror data from %s", url_object.source_relative_url)
             download_paths = await asyncio.gather(*tasks)
             return download_paths
 
     def transfer_files(self, stream: bool = False) -> List[str]:
-        logging.info("starting async task gathering")
+        logger.info("starting async task gathering")
         download_paths = asyncio.run(self.__gather_download_tasks(stream))
         return download_paths
 
@@ -1,13 +1,44 @@
-from ..utils.cloud_utils import get_s3_content, update_metadata, check_exists, get_client
-from .const import FTP_HOST, RFC_INFO_LIST
+from ..utils.cloud_utils import get_s3_content, update_metadata, list_keys, get_client
+from ..utils.prefetch import map_ahead
+from .const import FTP_HOST, RFC_INFO_LIST, RFC_INFO_BY_ALIAS, ZMETADATA_PATTERN
 from .transfer import TransferMetadata
 from .composite import CompositeMembershipMetadata
 from dataclasses import asdict
+from functools import lru_cache
 from typing import cast, Any
 import datetime
 import os
 import logging
 import re
+import threading
+
+# Mirror key listings by bucket, the lock makes concurrent callers wait on a single listing
+_MIRROR_KEYS: dict[str, frozenset[str]] = {}
+_MIRROR_KEYS_LOCK = threading.Lock()
+
+
+def get_mirror_keys(bucket: str, client: Any | None = None) -> frozenset[str]:
+    """Lists the mirrored source zip keys once so composite membership checks are set lookups rather than head requests
+
+    Args:
+        bucket (str): Bucket containing the mirrors
+        client (Any | None, optional): s3 client, only used for the first listing of a bucket. Defaults to None.
+
+    Returns:
+        frozenset[str]: Keys of all objects under the mirrors prefix
+    """
+    with _MIRROR_KEYS_LOCK:
+        mirror_keys = _MIRROR_KEYS.get(bucket)
+        if mirror_keys is None:
+            mirror_keys = frozenset(list_keys(bucket, "mirrors/aorc/precip/", client))
+            _MIRROR_KEYS[bucket] = mirror_keys
+    return mirror_keys
+
+
+@lru_cache(maxsize=1)
+def get_docker_image_url() -> str:
+    """Formats the docker image url from the environment once rather than per object"""
+    return f"https://hub.docker.com/layers/njroberts/blobfish-python/{os.environ['TAG']}/images/{os.environ['HASH']}?context=repo"
 
 
 class TransferMetaBuilder:
@@ -17,12 +48,13 @@ class TransferMetaBuilder:
         self.__verify()
         self.bucket = cast(str, self.base.get("Bucket"))
         self.mirror_uri = cast(str, self.base.get("Key"))
+        self.mirror_fn = self.mirror_uri.rpartition("/")[2]
         self.rfc_alias, self.rfc_name = self.__identify_rfc_info()
         self.precip_partition_uri = self.__construct_precip_partition()
         self.ref_date = self.__identify_ref_date()
         self.rfc_catalog_uri = self.__construct_catalog_url()
         self.source_uri = self.__construct_url()
-        self.docker_image = f"https://hub.docker.com/layers/njroberts/blobfish-python/{os.environ['TAG']}/images/{os.environ['HASH']}?context=repo"
+        self.docker_image = get_docker_image_url()
         self.mirror_script = "proj_blobfish_aorc_transfer.py"
         self.source_last_modified = "Mon, 01 Feb 2021 06:53:22 GMT"
         self.aorc_historic_uri = FTP_HOST
@@ -45,9 +77,9 @@ class TransferMetaBuilder:
         end_pos = self.mirror_uri.find("RFC")
         start_pos = end_pos - 2
         alias = self.mirror_uri[start_pos:end_pos]
-        for rfc in RFC_INFO_LIST:
-            if rfc.alias == alias:
-                return rfc.alias, rfc.name
+        rfc = RFC_INFO_BY_ALIAS.get(alias)
+        if rfc:
+            return rfc.alias, rfc.name
         logging.error(f"No matching rfc found for {self.mirror_uri}")
         raise AttributeError()
 
@@ -58,14 +90,12 @@ class TransferMetaBuilder:
         return f"/{self.rfc_alias}RFC_precip_partition"
 
     def __identify_ref_date(self):
-        fn = self.mirror_uri.split("/")[-1]
-        date_string = fn.split("_")[-1].replace(".zip", "")
+        date_string = self.mirror_fn.split("_")[-1].replace(".zip", "")
         date_dt = datetime.datetime.strptime(date_string, "%Y%m")
-        return date_dt.strftime("%Y-%m-%d")
+        return date_dt.date().isoformat()
 
     def __construct_url(self) -> str:
-        fn = self.mirror_uri.split("/")[-1]
-        formatted = f"{FTP_HOST}/AORC_{self.rfc_alias}RFC_4km/{self.rfc_alias}RFC_precip_partition/{fn}"
+        formatted = f"{FTP_HOST}/AORC_{self.rfc_alias}RFC_4km/{self.rfc_alias}RFC_precip_partition/{self.mirror_fn}"
         return formatted
 
     def __identify_bytes(self) -> str:
@@ -90,9 +120,10 @@ class TransferMetaBuilder:
 
 
 class CompositeMetaBuilder:
-    def __init__(self, s3_object: dict, client: Any | None):
+    def __init__(self, s3_object: dict, client: Any | None, mirror_keys: frozenset[str] | None = None):
         self.base = s3_object
         self.client = client
+        self.mirror_keys = mirror_keys
         self.__verify()
         self.bucket = cast(str, self.base.get("Bucket"))
         self.key = cast(str, self.base.get("Key"))
@@ -100,7 +131,7 @@ class CompositeMetaBuilder:
         self.start_time_dt = self.__identify_temporal_coverage()
         self.end_time_dt = self.start_time_dt + datetime.timedelta(hours=1)
         self.members = self.__identify_members()
-        self.docker_image_url = f"https://hub.docker.com/layers/njroberts/blobfish-python/{os.environ['TAG']}/images/{os.environ['HASH']}?context=repo"
+        self.docker_image_url = get_docker_image_url()
         self.composite_script = "proj_blobfish_aorc_composite.py"
 
     def __verify(self):
@@ -127,10 +158,15 @@ class CompositeMetaBuilder:
 
     def __identify_members(self) -> set[str]:
         member_set = set()
+        mirror_keys = self.mirror_keys
+        if mirror_keys is None:
+            mirror_keys = get_mirror_keys(self.bucket, self.client)
+        year_month = f"{self.start_time_dt.year:04d}{self.start_time_dt.month:02d}"
         for rfc_info in RFC_INFO_LIST:
-            key = f"mirrors/aorc/precip/AORC_{rfc_info.alias}RFC_4km/{rfc_info.alias}RFC_precip_partition/AORC_APCP_4KM_{rfc_info.alias}RFC_{self.start_time_dt.strftime('%Y%m')}.zip"
+            alias = rfc_info.alias
+            key = f"mirrors/aorc/precip/AORC_{alias}RFC_4km/{alias}RFC_precip_partition/AORC_APCP_4KM_{alias}RFC_{year_month}.zip"
             full_path = f"s3://{self.bucket}/{key}"
-            if check_exists(self.bucket, key, self.client):
+            if key in mirror_keys:
                 member_set.add(full_path)
             else:
                 logging.error(f"Supposed member of {self.zarr_key}, {full_path}, does not exist")
@@ -152,13 +188,20 @@ class CompositeMetaBuilder:
             raise KeyError
 
 
-def update_mirrors(bucket: str, prefix: str, client: Any | None = None):
-    for obj in get_s3_content(bucket, prefix, True, client):
+def update_mirrors(bucket: str, prefix: str, client: Any | None = None, workers: int = 32):
+    if not client:
+        client = get_client()
+
+    def update(obj: dict) -> None:
         try:
-            update_mirror(obj, bucket)
+            update_mirror(obj, bucket, client)
         except ValueError:
             logging.info(f"Object {obj.get('Key')} metadata has already been updated, skipping")
 
+    # Each update is a metadata copy_object request, so overlap them in a thread pool
+    for _ in map_ahead(update, get_s3_content(bucket, prefix, True, client), workers):
+        continue
+
 
 def update_mirror(mirror_object: dict, bucket: str, client: Any | None = None) -> None:
     new_meta_obj = TransferMetaBuilder(mirror_object, client)
@@ -166,40 +209,57 @@ def update_mirror(mirror_object: dict, bucket: str, client: Any | None = None) -
     update_metadata(bucket, new_meta_obj.mirror_uri, transfer_metadata, client)
 
 
-def update_composites(bucket: str, prefix: str, pattern: re.Pattern, client: Any | None = None) -> None:
-    for obj in get_s3_content(bucket, prefix, True, client):
+def update_composites(
+    bucket: str, prefix: str, pattern: re.Pattern, client: Any | None = None, workers: int = 32
+) -> None:
+    if not client:
+        client = get_client()
+    match = pattern.match
+    # Listed once before the pool starts rather than by the first workers to need it
+    mirror_keys = get_mirror_keys(bucket, client)
+
+    def update(obj: dict) -> None:
         key = cast(str, obj.get("Key"))
-        if re.match(pattern, key):
-            try:
-                update_composite(obj, bucket)
-            except ValueError:
-                logging.info(f"Object {key} metadata has already been updated, skipping")
+        try:
+            update_composite(obj, bucket, client, mirror_keys)
+        except ValueError:
+            logging.info(f"Object {key} metadata has already been updated, skipping")
+
+    # Keys are matched against the listing so only metadata objects (not every zarr chunk) get a head request
+    matched = get_s3_content(
+        bucket, prefix, True, client, listing_filter=lambda content: match(content.get("Key")) is not None
+    )
+    for _ in map_ahead(update, matched, workers):
+        continue
 
 
-def update_composite(mirror_object: dict, bucket: str, client: Any | None = None):
-    new_meta_obj = CompositeMetaBuilder(mirror_object, client)
+def update_composite(
+    mirror_object: dict, bucket: str, client: Any | None = None, mirror_keys: frozenset[str] | None = None
+):
+    new_meta_obj = CompositeMetaBuilder(mirror_object, client, mirror_keys)
     composite_metadata = new_meta_obj.serialize()
     update_metadata(bucket, new_meta_obj.key, composite_metadata, client)
 
 
+def update_composites_year(bucket: str, pattern: re.Pattern, year: int) -> None:
+    """Process pool entry point, each worker process resolves its own client as boto3 clients are not fork safe"""
+    update_composites(bucket, f"transforms/aorc/precipitation/{year}", pattern, get_client())
+
+
 if __name__ == "__main__":
     from dotenv import load_dotenv
-    from multiprocessing import Pool
+    from concurrent.futures import ProcessPoolExecutor
+    from functools import partial
     from ..utils.logger import set_up_logger
 
     set_up_logger(level=logging.INFO)
     load_dotenv()
 
     bucket = "tempest"
-    metadata_pattern = re.compile(r".*\.zmetadata$")
-
-    client = get_client()
-
-    # update_mirrors(bucket, "mirrors/aorc/precip", client)
 
-    def mappable_update(year: int):
-        return update_composites(bucket, f"transforms/aorc/precipitation/{year}", metadata_pattern)
+    # update_mirrors(bucket, "mirrors/aorc/precip", get_client())
 
-    with Pool(processes=44) as pool:
-        for i in pool.imap_unordered(mappable_update, range(1979, 2023)):
+    # Years run in separate processes, each overlapping its own s3 requests in a thread pool
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for _ in executor.map(partial(update_composites_year, bucket, ZMETADATA_PATTERN), range(1979, 2023)):
             continue
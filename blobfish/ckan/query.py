@@ -8,6 +8,7 @@ from shapely import Point, Polygon, MultiPolygon
 from zipfile import ZipFile
 from tempfile import TemporaryDirectory
 from dataclasses import dataclass
+from functools import lru_cache
 from collections.abc import Generator
 from rdflib import URIRef, Literal, BNode, RDF, DCTERMS
 from rdflib.namespace._GEO import GEO
@@ -17,26 +18,25 @@ from typing import cast
 from .const import RFC_SHP_URL, GEOF, SF, CKAN_URL
 from .load import RDFHandler
 from ..pyrdf import AORC
-from ..aorc.const import RFC_INFO_LIST
+from ..aorc.const import RFC_INFO_BY_ALIAS
 
 class CoverageGeometryType(enum.Enum):
     POLYGON = enum.auto()
     MULTIPOLYGON = enum.auto()
 
-@dataclass
+@dataclass(slots=True)
 class RFCCoverage:
     rfc: str
     wkt: str
     geom_type: CoverageGeometryType
 
-@dataclass
+@dataclass(slots=True)
 class RFCGeometry:
     rfc: str
     geom: Polygon | MultiPolygon
 
 
 def extract_shapes(zip_url: str, extract_dir: str) -> Generator[RFCGeometry, None, None]:
-    aliases = [rfc.alias for rfc in RFC_INFO_LIST]
     with requests.get(zip_url, stream=True) as resp:
         with ZipFile(BytesIO(resp.content)) as z:
             z.extractall(extract_dir)
@@ -44,16 +44,21 @@ def extract_shapes(zip_url: str, extract_dir: str) -> Generator[RFCGeometry, Non
             with fiona.open(shp_path, "r") as shp:
                 for f in shp:
                     rfc = f["properties"]["BASIN_ID"][:2]
-                    if rfc in aliases:
+                    if rfc in RFC_INFO_BY_ALIAS:
                         coverage_shape = shape(f["geometry"])
                         yield RFCGeometry(rfc, coverage_shape)
 
+@lru_cache(maxsize=8)
+def load_rfc_geometries(zip_url: str = RFC_SHP_URL) -> tuple[RFCGeometry, ...]:
+    """Downloads and parses the RFC shapefile once per url, as geometries are immutable and shared by every lookup"""
+    with TemporaryDirectory() as tmpdir:
+        return tuple(extract_shapes(zip_url, tmpdir))
+
 def identify_rfc_alias(x: float, y: float, zip_url: str = RFC_SHP_URL) -> str:
     point = Point(x, y)
-    with TemporaryDirectory() as tmpdir:
-        for coverage_shape in extract_shapes(zip_url, tmpdir):
-            if coverage_shape.geom.contains(point):
-                return coverage_shape.rfc
+    for coverage_shape in load_rfc_geometries(zip_url):
+        if coverage_shape.geom.contains(point):
+            return coverage_shape.rfc
     raise ValueError(f"Point ({x, y}) is not within RFC regions found in RFC_INFO_LIST. Check that input point and shapefile zip_url are in same CRS.")
 
 
@@ -65,14 +70,14 @@ class SpatialRDFHandler(RDFHandler):
             super().__init__(init_ttl = init_ttl)
 
     @staticmethod
-    def get_rfc_coverages(shp_url = RFC_SHP_URL) -> list[RFCCoverage]:
+    @lru_cache(maxsize=8)
+    def get_rfc_coverages(shp_url = RFC_SHP_URL) -> tuple[RFCCoverage, ...]:
         coverages = []
-        with TemporaryDirectory() as tmpdir:
-            for coverage_shape in extract_shapes(shp_url, tmpdir):
-                wkt = coverage_shape.geom.wkt
-                geom_type = CoverageGeometryType[coverage_shape.geom.geom_type.upper()]
-                coverages.append(RFCCoverage(coverage_shape.rfc, wkt, geom_type))
-        return coverages
+        for coverage_shape in load_rfc_geometries(shp_url):
+            wkt = coverage_shape.geom.wkt
+            geom_type = CoverageGeometryType[coverage_shape.geom.geom_type.upper()]
+            coverages.append(RFCCoverage(coverage_shape.rfc, wkt, geom_type))
+        return tuple(coverages)
 
     @staticmethod
     def prepend_crs(input_wkt: str) -> Literal:
@@ -81,22 +86,30 @@ class SpatialRDFHandler(RDFHandler):
         return literal
 
     def add_spatial_coverages(self) -> None:
-        self.graph.bind("geo", GEO)
-        self.graph.bind("sf", SF)
+        g = self.graph
+        g.bind("geo", GEO)
+        g.bind("sf", SF)
+        # Triples are collected as quads and added in one batch
+        quads = []
         for coverage in self.get_rfc_coverages():
             spatial_node = BNode()
-            self.graph.add((spatial_node, RDF.type, GEO.Feature))
             geom_node = BNode()
             if coverage.geom_type.name == "POLYGON":
                 geom_type = SF.Polygon
             else:
                 geom_type = SF.MultiPolygon
-            self.graph.add((geom_node, RDF.type, geom_type))
             wkt_literal = self.prepend_crs(coverage.wkt)
-            self.graph.add((geom_node, GEO.asWKT, wkt_literal))
-            self.graph.add((spatial_node, GEO.hasGeometry, geom_node))
             rfc_uri = URIRef(f"https://www.weather.gov/{coverage.rfc.lower()}rfc")
-            self.graph.add((rfc_uri, DCTERMS.spatial, spatial_node))
+            quads.extend(
+                (
+                    (spatial_node, RDF.type, GEO.Feature, g),
+                    (geom_node, RDF.type, geom_type, g),
+                    (geom_node, GEO.asWKT, wkt_literal, g),
+                    (spatial_node, GEO.hasGeometry, geom_node, g),
+                    (rfc_uri, DCTERMS.spatial, spatial_node, g),
+                )
+            )
+        g.addN(quads)
 
     def identify_rfc_datasets(self, x: float, y: float) -> Result:
         raise NotImplementedError("This function relies on geosparql functions which are not implemented in the SPARQL processor for RDFLib")
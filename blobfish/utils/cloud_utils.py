@@ -1,16 +1,42 @@
 import os
 import boto3
-from typing import Generator, Any
+import functools
+import gzip
+import shutil
+import tempfile
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from typing import Callable, Generator, Any, IO
 import logging
 
+from .prefetch import prefetch_merged, map_ahead
+
+
+MAX_POOL_CONNECTIONS = 64
+
+# Adaptive retries rate limit on the client side when s3 starts returning 503 SlowDown for bursts of requests
+CLIENT_CONFIG = Config(max_pool_connections=MAX_POOL_CONNECTIONS, retries={"max_attempts": 10, "mode": "adaptive"})
+
+# Large graph serializations are sent as multipart uploads with parts put in parallel
+GRAPH_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024, max_concurrency=16, use_threads=True
+)
+
 
 def get_client():
-    client = boto3.client(
-        service_name="s3",
+    # Clients are reused within a process but never shared with forked worker processes
+    return _get_process_client(os.getpid())
+
+
+@functools.lru_cache(maxsize=None)
+def _get_process_client(pid: int):
+    # Explicit session so client creation never touches the shared default session from worker threads
+    session = boto3.session.Session(
         aws_access_key_id=os.environ["AWS_ACCESS_KEY_ID"],
         aws_secret_access_key=os.environ["AWS_SECRET_ACCESS_KEY"],
         region_name=os.environ["AWS_DEFAULT_REGION"],
     )
+    client = session.client(service_name="s3", config=CLIENT_CONFIG)
     return client
 
 
@@ -35,20 +61,109 @@ def view_downloads(bucket: str, prefix: str, client: None | Any = None) -> None:
 
 
 def get_s3_content(
-    bucket: str, prefix: str, with_key: bool = False, client: None | Any = None
+    bucket: str,
+    prefix: str,
+    with_key: bool = False,
+    client: None | Any = None,
+    workers: int = 32,
+    listing_filter: Callable[[dict], bool] | None = None,
 ) -> Generator[dict, None, None]:
+    """Gets metadata of each object under prefix
+
+    Args:
+        bucket (str): Bucket name
+        prefix (str): Prefix to list
+        with_key (bool, optional): If True, add object key to returned metadata. Defaults to False.
+        client (None | Any, optional): s3 client. Defaults to None.
+        workers (int, optional): Head requests run at once. Defaults to 32.
+        listing_filter (Callable[[dict], bool] | None, optional): Predicate on listing entries (Key, ETag, LastModified),
+            objects it rejects are skipped without a head request. Defaults to None.
+
+    Yields:
+        Generator[dict, None, None]: Head object responses in key order
+    """
+    if not client:
+        client = get_client()
+    listing = list_objects(bucket, prefix, client)
+    if listing_filter:
+        listing = filter(listing_filter, listing)
+    # Head requests for listed keys run in a thread pool, objects are yielded in key order
+    yield from map_ahead(
+        lambda content: get_object_metadata(bucket, content.get("Key"), with_key, client),
+        listing,
+        workers,
+        workers * 2,
+    )
+
+
+def list_objects(bucket: str, prefix: str, client: None | Any = None) -> Generator[dict, None, None]:
+    """Lists entries (Key, ETag, LastModified, Size) of objects under prefix without retrieving their metadata"""
     if not client:
         client = get_client()
     paginator = client.get_paginator("list_objects_v2")
-    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
-        contents = page.get("Contents", [])
-        for content in contents:
-            key = content.get("Key")
-            object = client.head_object(Bucket=bucket, Key=key)
-            object["Bucket"] = bucket
-            if with_key:
-                object["Key"] = key
-            yield object
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, PaginationConfig={"PageSize": 1000}):
+        yield from page.get("Contents", [])
+
+
+def list_keys(bucket: str, prefix: str, client: None | Any = None) -> Generator[str, None, None]:
+    """Lists keys under prefix without retrieving the metadata of each object"""
+    for content in list_objects(bucket, prefix, client):
+        yield content.get("Key")
+
+
+def get_object_metadata(bucket: str, key: str, with_key: bool = False, client: None | Any = None) -> dict:
+    if not client:
+        client = get_client()
+    object = client.head_object(Bucket=bucket, Key=key)
+    object["Bucket"] = bucket
+    if with_key:
+        object["Key"] = key
+    return object
+
+
+def get_sub_prefixes(bucket: str, prefix: str, client: None | Any = None) -> tuple[list[str], list[dict]]:
+    """Lists one level below prefix, descending while the prefix only holds a single sub-prefix
+
+    Returns:
+        tuple[list[str], list[dict]]: Sub-prefixes and listing entries of objects found directly under the final prefix
+    """
+    if not client:
+        client = get_client()
+    paginator = client.get_paginator("list_objects_v2")
+    while True:
+        sub_prefixes, contents = [], []
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter="/"):
+            sub_prefixes.extend(common_prefix.get("Prefix") for common_prefix in page.get("CommonPrefixes", []))
+            contents.extend(page.get("Contents", []))
+        if len(sub_prefixes) != 1 or len(contents) > 0:
+            return sub_prefixes, contents
+        prefix = sub_prefixes[0]
+
+
+def get_s3_content_parallel(
+    bucket: str,
+    prefix: str,
+    with_key: bool = False,
+    client: None | Any = None,
+    workers: int = 32,
+    listing_filter: Callable[[dict], bool] | None = None,
+) -> Generator[dict, None, None]:
+    """Same as get_s3_content, but partitions the prefix on its sub-prefixes and lists each partition in its own thread.
+    Objects are yielded in the order they are retrieved rather than in key order.
+    """
+    if not client:
+        client = get_client()
+    sub_prefixes, contents = get_sub_prefixes(bucket, prefix, client)
+    # Head requests of all partitions share the client connection pool
+    head_workers = max(1, MAX_POOL_CONNECTIONS // max(1, min(workers, len(sub_prefixes))))
+    listings = [
+        get_s3_content(bucket, sub_prefix, with_key, client, head_workers, listing_filter)
+        for sub_prefix in sub_prefixes
+    ]
+    if listing_filter:
+        contents = [content for content in contents if listing_filter(content)]
+    listings.append(get_object_metadata(bucket, content.get("Key"), with_key, client) for content in contents)
+    yield from prefetch_merged(listings, workers)
 
 
 def update_metadata(bucket: str, key: str, new_meta: dict, client: None | Any = None) -> None:
@@ -74,14 +189,62 @@ def check_exists(bucket: str, key: str, client: None | Any = None) -> bool:
     return False
 
 
-def upload_graph_ttl(bucket: str, key: str, ttl_body: str, client: None | Any = None) -> None:
+def upload_graph_ttl(bucket: str, key: str, ttl_body: str | bytes | IO[bytes], client: None | Any = None) -> None:
     if not client:
         client = get_client()
     client.put_object(Bucket=bucket, Key=key, Body=ttl_body)
 
 
+def put_object_body(
+    bucket: str, key: str, body: str | bytes, content_type: str, client: None | Any = None
+) -> None:
+    """Uploads a small non graph object (ie json state) in a single put request
+
+    Args:
+        bucket (str): Target bucket
+        key (str): Target key
+        body (str | bytes): Object content
+        content_type (str): MIME type stored with the object, ie "application/json"
+        client (None | Any, optional): s3 client. Defaults to None.
+    """
+    if not client:
+        client = get_client()
+    client.put_object(Bucket=bucket, Key=key, Body=body, ContentType=content_type)
+
+
+def upload_graph_fileobj(
+    bucket: str, key: str, fileobj: IO[bytes], client: None | Any = None, compress: bool = False
+) -> None:
+    """Uploads a serialized graph from a binary file object, rewinding it first so it can be passed straight after serialization
+
+    Args:
+        bucket (str): Target bucket
+        key (str): Target key
+        fileobj (IO[bytes]): Serialized graph
+        client (None | Any, optional): s3 client. Defaults to None.
+        compress (bool, optional): If True, gzip the body and store it with Content-Encoding gzip, which http clients
+            decompress transparently and get_object_body_string decompresses for boto3 readers. Defaults to False.
+    """
+    if not client:
+        client = get_client()
+    fileobj.seek(0)
+    if not compress:
+        client.upload_fileobj(fileobj, bucket, key, Config=GRAPH_TRANSFER_CONFIG)
+        return
+    with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as compressed:
+        with gzip.GzipFile(fileobj=compressed, mode="wb", compresslevel=6) as gz:
+            shutil.copyfileobj(fileobj, gz)
+        compressed.seek(0)
+        client.upload_fileobj(
+            compressed, bucket, key, ExtraArgs={"ContentEncoding": "gzip"}, Config=GRAPH_TRANSFER_CONFIG
+        )
+
+
 def get_object_body_string(bucket: str, key: str, client: None | Any = None):
     if not client:
         client = get_client()
     obj = client.get_object(Bucket=bucket, Key=key)
+    # boto3 does not undo Content-Encoding, so compressed graph uploads are decompressed as they are read
+    if obj.get("ContentEncoding") == "gzip":
+        return gzip.GzipFile(fileobj=obj.get("Body"), mode="rb")
     return obj.get("Body")
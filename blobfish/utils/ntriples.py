@@ -0,0 +1,64 @@
+""" Sink used to write RDF triples as N-Triples lines without building an rdflib graph store """
+import functools
+import re
+from typing import IO, Iterable
+from rdflib.term import BNode, Node
+
+# Blank node labels are limited to a small character set, other characters (ie : and . in timestamps) are escaped
+UNSAFE_LABEL_CHARS = re.compile(r"[^A-Za-z0-9]")
+
+
+def escape_label(label: str) -> str:
+    """Escapes a blank node label to alphanumerics, writing each other character as _<hex code point>_ so that
+    distinct labels stay distinct
+
+    Args:
+        label (str): Raw blank node label (ie composite period name)
+
+    Returns:
+        str: Label valid in both N-Triples and turtle
+    """
+    return UNSAFE_LABEL_CHARS.sub(lambda match: f"_{ord(match.group()):x}_", label)
+
+
+@functools.lru_cache(maxsize=4096)
+def term_n3(term: Node) -> str:
+    """Gets the N-Triples representation of an rdflib term, caching terms which repeat across records (ie predicates, classes)
+
+    Args:
+        term (Node): URIRef, BNode, or Literal to format
+
+    Returns:
+        str: N-Triples formatted term
+    """
+    if isinstance(term, BNode):
+        return f"_:{escape_label(term)}"
+    return term.n3()
+
+
+class NTriplesSink:
+    """Write-only stand in for rdflib.Graph which streams each added triple to a binary file object"""
+
+    def __init__(self, fileobj: IO[bytes]) -> None:
+        self.fileobj = fileobj
+        self.triple_count = 0
+
+    def add(self, triple: tuple[Node, Node, Node]) -> None:
+        s, p, o = triple
+        self.fileobj.write(f"{term_n3(s)} {term_n3(p)} {term_n3(o)} .\n".encode("utf-8"))
+        self.triple_count += 1
+
+    def addN(self, quads: Iterable[tuple[Node, Node, Node, object]]) -> None:
+        for s, p, o, _ in quads:
+            self.add((s, p, o))
+
+    def write_ntriples(self, ntriples: bytes) -> None:
+        """Appends already serialized N-Triples to the sink"""
+        self.fileobj.write(ntriples)
+        self.triple_count += ntriples.count(b"\n")
+
+    def __len__(self) -> int:
+        return self.triple_count
+
+    def close(self) -> None:
+        self.fileobj.close()
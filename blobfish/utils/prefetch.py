@@ -0,0 +1,153 @@
+""" Utility to overlap network bound producers with the cpu bound work consuming them """
+import collections
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, ThreadPoolExecutor, wait
+from typing import Callable, Iterable, Generator, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+_DONE = object()
+
+
+def prefetch_merged(
+    iterables: Iterable[Iterable[T]], workers: int = 32, maxsize: int = 1000
+) -> Generator[T, None, None]:
+    """Drains several iterables concurrently in background threads, yielding items in the order they arrive
+
+    Args:
+        iterables (Iterable[Iterable[T]]): Producers to run in the background (ie one s3 listing per prefix)
+        workers (int, optional): Maximum number of producers drained at once. Defaults to 32.
+        maxsize (int, optional): Maximum number of items buffered ahead of the consumer. Defaults to 1000.
+
+    Yields:
+        Generator[T, None, None]: Items of all iterables
+
+    Raises:
+        BaseException: The first exception raised by a producer, as soon as it is received
+    """
+    buffer: queue.Queue = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    errors = []
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce(iterable: Iterable[T]) -> None:
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as exc:
+            errors.append(exc)
+        finally:
+            put(_DONE)
+
+    producers = list(iterables)
+    remaining = len(producers)
+    executor = ThreadPoolExecutor(max_workers=max(1, min(workers, remaining)))
+    for producer in producers:
+        executor.submit(produce, producer)
+    try:
+        while remaining > 0:
+            item = buffer.get()
+            if item is _DONE:
+                # A failed producer is raised as soon as it finishes rather than after the others drain
+                if errors:
+                    raise errors[0]
+                remaining -= 1
+                continue
+            yield item
+    finally:
+        # Release the producers if the consumer stops early or a producer fails, producers which have not
+        # started are cancelled and running ones stop at their next item without being waited on
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def prefetch(iterable: Iterable[T], maxsize: int = 1000) -> Generator[T, None, None]:
+    """Drains an iterable in a background thread, buffering up to maxsize items for the consumer
+
+    Args:
+        iterable (Iterable[T]): Producer to run in the background (ie s3 listing and metadata retrieval)
+        maxsize (int, optional): Maximum number of items buffered ahead of the consumer. Defaults to 1000.
+
+    Yields:
+        Generator[T, None, None]: Items of the iterable in order
+    """
+    return prefetch_merged([iterable], 1, maxsize)
+
+
+def map_ahead(
+    func: Callable[[T], R], iterable: Iterable[T], workers: int = 32, max_pending: int = 64
+) -> Generator[R, None, None]:
+    """Applies func to items in a thread pool, keeping up to max_pending calls in flight ahead of the consumer
+
+    Args:
+        func (Callable[[T], R]): Network bound function to apply (ie s3 head request)
+        iterable (Iterable[T]): Inputs, consumed lazily from the calling thread
+        workers (int, optional): Maximum number of calls running at once. Defaults to 32.
+        max_pending (int, optional): Maximum number of calls submitted but not yet yielded. Defaults to 64.
+
+    Yields:
+        Generator[R, None, None]: Results in the same order as their inputs
+    """
+    pending: collections.deque[Future] = collections.deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for item in iterable:
+                pending.append(executor.submit(func, item))
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Drop queued calls if the consumer stops early or a call fails
+            for future in pending:
+                future.cancel()
+
+
+def map_as_completed(
+    func: Callable[[T], R],
+    iterable: Iterable[T],
+    workers: int = 32,
+    max_pending: int = 64,
+    executor_type: type[Executor] = ThreadPoolExecutor,
+) -> Generator[R, None, None]:
+    """Applies func to items in a pool, yielding results as they finish with at most max_pending calls in flight
+
+    Args:
+        func (Callable[[T], R]): Function to apply (ie s3 object download)
+        iterable (Iterable[T]): Inputs, consumed lazily from the calling thread
+        workers (int, optional): Maximum number of calls running at once. Defaults to 32.
+        max_pending (int, optional): Maximum number of calls submitted but not yet yielded. Defaults to 64.
+        executor_type (type[Executor], optional): Pool to run calls in, ie ProcessPoolExecutor for cpu bound
+            calls. Defaults to ThreadPoolExecutor.
+
+    Yields:
+        Generator[R, None, None]: Results in the order they finish
+    """
+    pending: set[Future] = set()
+    with executor_type(max_workers=workers) as executor:
+        try:
+            for item in iterable:
+                pending.add(executor.submit(func, item))
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            # Drop queued calls if the consumer stops early or a call fails
+            for future in pending:
+                future.cancel()
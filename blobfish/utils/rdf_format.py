@@ -0,0 +1,39 @@
+""" Utility to pick the rdflib serialization format for a graph file from its extension """
+import pathlib
+from typing import Generator
+from rdflib.util import guess_format
+
+# Extensions of graph partitions written by the mirror and composite graph scripts, N-Triples is also valid turtle
+GRAPH_FILE_PATTERNS = ("*.ttl", "*.nt")
+
+
+def rdf_format(path: str, default: str = "ttl") -> str:
+    """Gets the rdflib format name for a file path, falling back to turtle
+
+    Args:
+        path (str): Local path or s3 key of serialized graph
+        default (str, optional): Format used when the extension is not recognized. Defaults to "ttl".
+
+    Returns:
+        str: rdflib format name. ".jelly" maps to the Jelly binary format, which requires the pyjelly rdflib plugin to be installed
+    """
+    if path.endswith(".jelly"):
+        return "jelly"
+    return guess_format(path) or default
+
+
+def iter_graph_files(
+    directory: str, patterns: tuple[str, ...] = GRAPH_FILE_PATTERNS
+) -> Generator[pathlib.Path, None, None]:
+    """Lists the serialized graph files in a directory, whether they were written as turtle or N-Triples
+
+    Args:
+        directory (str): Local directory holding graph partitions
+        patterns (tuple[str, ...], optional): Glob patterns of graph files. Defaults to GRAPH_FILE_PATTERNS.
+
+    Yields:
+        Generator[pathlib.Path, None, None]: Paths of matching graph files
+    """
+    path = pathlib.Path(directory)
+    for pattern in patterns:
+        yield from path.glob(pattern)
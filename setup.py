@@ -25,5 +25,5 @@ setuptools.setup(
         "Programming Language :: Python :: 3",
         "Operating System :: linux_x86_64",
     ],
-    python_requires=">=3.9",
+    python_requires=">=3.10",
 )
@@ -0,0 +1,60 @@
+import pathlib
+
+import pytest
+from rdflib import Graph
+from rdflib.compare import isomorphic
+
+from blobfish.aorc import parse_composite
+from blobfish.aorc.parse_composite import CompletedCompositeMetadata, NodeNamer, create_graph_triples, new_graph
+from blobfish.utils.ntriples import escape_label
+
+SOURCE_TTL = """
+@prefix dct: <http://purl.org/dc/terms/> .
+<s3://tempest/mirrors/aorc/precip/CBRFC_197902/file.nc.gz> dct:temporal [ dct:identifier "1979-02" ] .
+"""
+
+
+def composite_meta(start_time: str, end_time: str) -> CompletedCompositeMetadata:
+    return CompletedCompositeMetadata(
+        start_time=start_time,
+        end_time=end_time,
+        docker_image_url="https://hub.docker.com/layers/njroberts/aorc-composite/v1",
+        members="s3://tempest/mirrors/aorc/precip/CBRFC_197902/file.nc.gz",
+        composite_last_modified="2023-03-01T12:00:00+00:00",
+        composite_s3_directory=f"s3://tempest/transforms/aorc/precip/{start_time[:4]}/{start_time}.zarr",
+        composite_script="https://github.com/Dewberry/blobfish/blob/main/blobfish/aorc/composite.py",
+    )
+
+
+METAS = [
+    composite_meta("1979-02-01T00:00:00", "1979-02-01T01:00:00"),
+    composite_meta("1979-02-01T01:00:00", "1979-02-01T02:00:00"),
+]
+
+
+def test_escape_label_is_alphanumeric_and_distinct():
+    labels = ["1979-02-01T00:00:00_1979-02-01T01:00:00", "a:b", "a.b", "a_b", "a_3a_b"]
+    escaped = [escape_label(label) for label in labels]
+    assert all(label.replace("_", "").isalnum() for label in escaped)
+    assert len(set(escaped)) == len(labels)
+
+
+@pytest.mark.parametrize("extension", ["nt", "ttl"])
+def test_streamed_composite_graph_round_trips(tmp_path: pathlib.Path, monkeypatch, extension: str):
+    source_directory = tmp_path / "graphs"
+    source_directory.mkdir()
+    (source_directory / "CBRFC_197902.ttl").write_text(SOURCE_TTL)
+    monkeypatch.setattr(parse_composite, "get_meta", lambda *args, **kwargs: iter(METAS))
+
+    output_path = tmp_path / f"composite.{extension}"
+    parse_composite.stream_composite_graph(
+        str(source_directory), "*.ttl", "tempest", "transforms", None, str(output_path), NodeNamer(), None
+    )
+    streamed = Graph().parse(output_path, format="nt" if extension == "nt" else "turtle")
+
+    expected = new_graph()
+    expected.parse(data=SOURCE_TTL, format="turtle")
+    node_namer = NodeNamer()
+    for meta in METAS:
+        create_graph_triples(meta, expected, node_namer)
+    assert isomorphic(streamed, expected)
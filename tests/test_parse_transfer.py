@@ -0,0 +1,134 @@
+import pathlib
+
+import pytest
+from rdflib import DCTERMS, RDF, Graph
+from rdflib.compare import isomorphic
+
+from blobfish.aorc import parse_transfer
+from blobfish.aorc.parse_transfer import (
+    NS_PREFIXES,
+    AORCFilter,
+    CompletedTransferMetadata,
+    GraphCreator,
+    NodeNamer,
+    build_ntriples_batch,
+    create_graph_triples,
+)
+from blobfish.pyrdf import AORC
+from blobfish.utils.rdf_format import iter_graph_files, rdf_format
+
+MONTHS = ["1979-02-01", "1979-03-01", "1979-04-01", "1979-05-01"]
+
+
+@pytest.fixture
+def metas(monkeypatch) -> list[CompletedTransferMetadata]:
+    monkeypatch.setattr(parse_transfer, "validate_rfc_office_page", lambda alias: f"https://www.weather.gov/{alias}rfc")
+    completed = []
+    for ref_date in MONTHS:
+        year_month = ref_date[:7].replace("-", "")
+        completed.append(
+            CompletedTransferMetadata(
+                rfc_name="Colorado Basin River Forecast Center",
+                rfc_alias="CB",
+                rfc_catalog_uri="AORC_CBRFC_4km/",
+                precip_partition_uri="CB_precip_partition/",
+                source_uri=f"AORC_APCP_4KM_CB_{year_month}.zip",
+                mirror_uri=f"mirrors/aorc/precip/CB/{year_month}.zip",
+                ref_date=ref_date,
+                docker_image_url="https://hub.docker.com/layers/njroberts/aorc-mirror/v1",
+                mirror_script="https://github.com/Dewberry/blobfish/blob/main/blobfish/aorc/transfer.py",
+                aorc_historic_uri="https://hydrology.nws.noaa.gov/aorc-historic/",
+                source_last_modified="Tue, 14 Mar 2023 15:30:00 GMT",
+                source_bytes="1024",
+                mirror_last_modified="2023-03-15T00:00:00+00:00",
+                bucket="tempest",
+            )
+        )
+    return completed
+
+
+def write_graphs(
+    metas: list[CompletedTransferMetadata], filepath_pattern: str, stream: bool, existing_pattern: str | None = None
+) -> None:
+    graph_creator = GraphCreator(NS_PREFIXES, stream)
+    namer = NodeNamer()
+    if existing_pattern:
+        for existing_graph in graph_creator.load_existing(existing_pattern):
+            namer.seed(existing_graph)
+    for meta in metas:
+        create_graph_triples(meta, graph_creator, namer, AORCFilter.RFC)
+    graph_creator.serialize_graphs(filepath_pattern)
+
+
+@pytest.mark.parametrize("stream, extension", [(False, "nt"), (True, "nt"), (True, "ttl")])
+def test_incremental_graph_matches_full_graph(
+    tmp_path: pathlib.Path, metas: list[CompletedTransferMetadata], stream: bool, extension: str
+):
+    full_pattern = str(tmp_path / f"full_{{0}}.{extension}")
+    first_pattern = str(tmp_path / f"first_{{0}}.{extension}")
+    incremental_pattern = str(tmp_path / f"incremental_{{0}}.{extension}")
+    write_graphs(metas, full_pattern, stream)
+    write_graphs(metas[:2], first_pattern, stream)
+    # Incremental run is given every month, the first two are already documented
+    write_graphs(metas, incremental_pattern, stream, first_pattern)
+
+    rdf_format = "nt" if extension == "nt" else "turtle"
+    full = Graph().parse(full_pattern.format("CB"), format=rdf_format)
+    incremental = Graph().parse(incremental_pattern.format("CB"), format=rdf_format)
+    assert len(list(incremental.subjects(RDF.type, AORC.TransferScript))) == 1
+    assert len(list(incremental.subjects(RDF.type, DCTERMS.PeriodOfTime))) == len(MONTHS)
+    assert isomorphic(full, incremental)
+
+
+def test_merged_batches_reuse_loaded_nodes(tmp_path: pathlib.Path, metas: list[CompletedTransferMetadata]):
+    first_pattern = str(tmp_path / "first_{0}.nt")
+    write_graphs(metas[:2], first_pattern, False)
+
+    graph_creator = GraphCreator(NS_PREFIXES)
+    graph_creator.load_existing(first_pattern)
+    for filter_key, ntriples in build_ntriples_batch(metas[2:], AORCFilter.RFC):
+        graph_creator.merge_ntriples(filter_key, ntriples)
+
+    full = GraphCreator(NS_PREFIXES)
+    namer = NodeNamer()
+    for meta in metas:
+        create_graph_triples(meta, full, namer, AORCFilter.RFC)
+    assert isomorphic(graph_creator.get_graph("CB"), full.get_graph("CB"))
+
+
+def test_streamed_batches_round_trip_as_turtle(tmp_path: pathlib.Path, metas: list[CompletedTransferMetadata]):
+    graph_creator = GraphCreator(NS_PREFIXES, stream=True)
+    for batch in (metas[:2], metas[2:]):
+        for filter_key, ntriples in build_ntriples_batch(batch, AORCFilter.RFC, stream=True):
+            graph_creator.merge_ntriples(filter_key, ntriples)
+    filepath_pattern = str(tmp_path / "merged_{0}.ttl")
+    graph_creator.serialize_graphs(filepath_pattern)
+
+    merged = Graph().parse(filepath_pattern.format("CB"), format="turtle")
+    assert len(list(merged.subjects(RDF.type, AORC.TransferScript))) == 1
+    assert len(list(merged.subjects(RDF.type, DCTERMS.PeriodOfTime))) == len(MONTHS)
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_nt_partitions_are_found_by_graph_loaders(
+    tmp_path: pathlib.Path, metas: list[CompletedTransferMetadata], stream: bool
+):
+    # Script output is written as .nt partitions, composite graph loading must pick them up
+    write_graphs(metas, str(tmp_path / "{0}.nt"), stream)
+    (tmp_path / "notes.txt").write_text("not a graph")
+
+    graph_files = list(iter_graph_files(str(tmp_path)))
+    assert [filepath.name for filepath in graph_files] == ["CB.nt"]
+    loaded = Graph()
+    for filepath in graph_files:
+        loaded.parse(filepath, format=rdf_format(str(filepath)))
+    assert len(list(loaded.subjects(RDF.type, AORC.SourceDataset))) == len(MONTHS)
+
+
+def test_composite_graph_loads_nt_partitions(tmp_path: pathlib.Path, metas: list[CompletedTransferMetadata]):
+    composite = pytest.importorskip("blobfish.aorc.composite", exc_type=ImportError)
+    write_graphs(metas[:2], str(tmp_path / "{0}.ttl"), True)
+    write_graphs(metas[2:], str(tmp_path / "{0}.nt"), False)
+
+    g = composite.create_graph(str(tmp_path))
+    assert len(list(g.subjects(RDF.type, AORC.SourceDataset))) == len(MONTHS)